@@ -0,0 +1,65 @@
+# Background baseline for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The background limits in limits_scanned come from the last calibration, but the belt color and the light around the
+# machine change during a sorting run. A BackgroundBaseline keeps the last readings of 1 color sensor while it waits for
+# a pin. When a pin is detected, the readings just before it give the background as it is now. The newest ones are
+# skipped: the 3 readings that detected the pin, and the ones on its edge. The first readings after the previous pin are
+# not used either, the sensor still sees a bit of that pin there. A pin edge is only a few ° on the belt, but the white
+# sensor takes about 6 times more readings per ° than the black sensor, so both get their own numbers.
+# The readings just outside the limits do count, leaving them out would pull the baseline back to the old background
+# exactly when it drifts away.
+# The difference with the calibrated background is the drift. It moves the live background limits that start a pin
+# detection, and it is taken off the pin colors, so a pin keeps the colors the pins_scanned datasets were made with.
+# The drift is followed a bit every pin and never more then a maximum, so 1 bad baseline cannot move the limits that
+# far that every reading is a pin. The readings are whole numbers, so the limits and colors only move in whole steps,
+# and only when the drift is clearly past the next step: a limit moved back and forth by noise makes noise look like a pin.
+# A dark pin on the black belt can read inside the background limits for a while before it is detected, and those
+# readings pull the black baseline towards the pin color. Without any drift that still moves the black limits now and
+# then, so track_background is off by default and only worth it on a machine where the light really changes.
+
+from array import array
+
+
+class BackgroundBaseline:
+    """
+    BackgroundBaseline
+    Drift of 1 color sensor's empty belt reading since the calibration, from the readings right before every pin.
+    """
+
+    def __init__(self, limits, live, first, size, skip, lead, rate=0.25, maximum=5):
+        self.limits    = limits                                                     #Calibrated background limits, all 12 (white lower RGB, upper RGB, black lower RGB, upper RGB)
+        self.live      = live                                                       #Background limits used for the detection, the same layout, moved with the drift
+        self.first     = first                                                      #0 for the white sensor, 6 for the black sensor
+        self.reference = [(limits[first + x] + limits[first + x + 3]) / 2 for x in range(3)]     #Middle of the calibrated limits, the background the datasets go with
+        self.drift     = array('f', [0, 0, 0])                                      #Per R G B, how much the empty belt reads higher then at the calibration
+        self.step      = array('i', [0, 0, 0])                                      #The drift in whole numbers, the readings and most dataset limits are whole numbers too
+        self.readings  = [None] * size                                              #Last readings while waiting for a pin, used as a ring
+        self.size      = size
+        self.skip      = skip                                                       #Newest readings not used, they can be on the pin already
+        self.lead      = lead                                                       #Readings after the previous pin that are never used, they can still be on that pin
+        self.rate      = rate                                                       #Part of the difference with the new baseline that is followed every pin
+        self.maximum   = maximum                                                    #Largest drift followed per color
+        self.count     = 0
+
+    def add(self, scan):                                                            #Save 1 reading, called for every sample while waiting for a pin
+        self.readings[self.count % self.size] = scan
+        self.count += 1
+
+    def update(self):                                                               #A pin is detected, make the baseline from the readings before it and move the live limits
+        count      = self.count
+        usable     = min(count - self.lead, self.size) - self.skip
+        self.count = 0                                                              #The next baseline only uses readings taken after this pin
+        if usable < 3: return                                                       #Pins to close after each other, keep the drift as it is
+        for x in range(3):
+            total = 0
+            for back in range(self.skip, self.skip + usable):
+                total += self.readings[(count - 1 - back) % self.size][x]
+            drift = min(self.maximum, max(-self.maximum, total / usable - self.reference[x]))
+            self.drift[x] += (drift - self.drift[x]) * self.rate
+            if abs(self.drift[x] - self.step[x]) > 0.75: self.step[x] = round(self.drift[x])   #Only a clear change moves the limits, a limit moved by noise makes noise look like a pin
+            self.live[self.first + x]     = self.limits[self.first + x] + self.step[x]
+            self.live[self.first + x + 3] = self.limits[self.first + x + 3] + self.step[x]
+
+    def correct(self, color):                                                       #Pin R G B with the drift taken off
+        return [round(color[x] - self.step[x], 1) for x in range(3)]
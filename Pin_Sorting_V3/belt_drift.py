@@ -0,0 +1,35 @@
+# Belt drift tracking for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The black sensor takes its color samples a fixed distance after the pin started at the white sensor. That distance
+# is the spacing between both sensors, and it only stays right as long as nothing on the machine moves: a sensor holder
+# that shifts, or a belt that starts to slip over its drive axle, makes the motor turn more or less for the same belt
+# motion. Every pin measured on both sensors gives the spacing again (start_distance in pin_records.py), so a BeltDrift
+# keeps the last ones and uses their median. A pin that was matched to the wrong start does not move a median.
+# slip is the learned spacing divided by the spacing the machine was built with, other distances on the belt scale with it.
+
+from array import array
+from pin_classifier import median
+
+
+class BeltDrift:
+    """
+    BeltDrift
+    Running median of the measured white to black sensor spacing, and the belt slip it shows.
+    """
+
+    def __init__(self, spacing, size=15, minimum=5):
+        self.nominal   = spacing                                                    #° between both sensors when the machine was set up
+        self.spacing   = spacing                                                    #° between both sensors now, learned from the measured pins
+        self.slip      = 1.0                                                        #spacing / nominal, more then 1 if the motor turns more for the same belt motion
+        self.distances = array('f', [0] * size)                                     #Last measured start distances, used as a ring
+        self.size      = size
+        self.minimum   = minimum                                                    #Measurements needed before the nominal spacing is left
+        self.count     = 0
+
+    def add(self, distance):                                                        #Add 1 measured start distance, only called by the black sensor stage
+        self.distances[self.count % self.size] = distance
+        self.count += 1
+        if self.count < self.minimum: return
+        self.spacing = round(median(self.distances[:min(self.count, self.size)]), 1)
+        self.slip    = self.spacing / self.nominal
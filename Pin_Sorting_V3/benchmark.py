@@ -0,0 +1,166 @@
+# Throughput benchmark for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# Runs a sorting program in the simulator (see simulator.py) for every combination of the given settings and seeds, and
+# writes how fast and how well it sorted to a JSON file. Compare that file with an earlier one to see if a change in the
+# settings or the code made the sorter slower, before it goes on the real machine.
+#
+# Example, 3 seeds for 2 scanning speeds, and check against an earlier result:
+#   python3 benchmark.py main_v5_esp.py --seconds 300 --seeds 0 1 2 --set speed_scanner=600,800 --output new.json --compare old.json
+#
+# Threads against the cooperative scheduler, on 1 processor core like the EV3:
+#   python3 benchmark.py main_v5_esp.py --single-core --set cooperative_scheduler=False,True
+#
+# A trace recorded on the machine (record_trace = True, see sensor_trace.py) instead of the simulated pins, every run
+# then sees the same recorded samples and stops at the end of the trace:
+#   python3 benchmark.py main_v5_esp.py --replay trace.bin --seeds 0 --set classify_mode=box,score
+#
+# Measured for every run:
+#   pins_per_minute       pins sorted (not counting ReScan and Reject) per minute of virtual time
+#   rescan_percent        rescans and rejects, as a percentage of the sorted pins (same as the EV3 screen shows)
+#   belt_brakes           times the scanning belt was braked, for a rescan or to make a gap for the swingarm
+#   arm_waits             times the belts were stopped to give the swingarm time to turn
+#   average_arm_wait_ms   average time the scanning belt stood still for 1 of those waits
+#   sort_accuracy         percentage of the binned pins that landed in the correct bin
+#   white_sample_rate     color readings per second of the white background sensor (black_sample_rate the same)
+#   white_jitter          standard deviation in ° of how far a pin front was past the white sensor when it was first seen
+
+import argparse
+import ast
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import simulator
+
+
+METRICS = ["pins_per_minute", "pins_sorted", "rescan_percent", "rejects", "belt_brakes", "arm_waits", "average_arm_wait_ms", "sort_accuracy",
+           "white_sample_rate", "black_sample_rate", "white_jitter", "black_jitter"]
+REGRESSION_CHECKS = {"pins_per_minute": 1, "sort_accuracy": 1, "rescan_percent": -1}      #Metric: 1 if higher is better, -1 if lower is better
+
+
+def measure(program, stats):                                                        #Turn the program counters and the simulator stats into the benchmark metrics
+    sorted_pins = 0
+    rescans     = 0
+    for name in program["pins_scanned"]:
+        if name == "ReScan" or name == "Reject": rescans += program["pins_scanned"][name]["counter"]
+        else: sorted_pins += program["pins_scanned"][name]["counter"]
+    minutes = stats["virtual_seconds"] / 60
+    result = {}
+    result["pins_per_minute"]     = round(sorted_pins / minutes, 2) if minutes > 0 else 0
+    result["pins_sorted"]         = sorted_pins
+    result["rescan_percent"]      = round(rescans / sorted_pins * 100, 1) if sorted_pins > 0 else 0
+    result["rejects"]             = program["pins_scanned"]["Reject"]["counter"] if "Reject" in program["pins_scanned"] else 0
+    result["belt_brakes"]         = stats["scanning_brakes"]
+    result["arm_waits"]           = stats["feeder_stops"]                           #The feeder belts are only stopped for a swingarm gap
+    result["average_arm_wait_ms"] = round(stats["scanning_stopped_ms"] / stats["feeder_stops"]) if stats["feeder_stops"] > 0 else 0
+    result["sort_accuracy"]       = round(stats["pins_correct"] / stats["pins_binned"] * 100, 1) if stats["pins_binned"] > 0 else 0
+    result["white_sample_rate"]   = stats["white_samples_per_second"]
+    result["black_sample_rate"]   = stats["black_samples_per_second"]
+    result["white_jitter"]        = stats["white_detection_jitter"]
+    result["black_jitter"]        = stats["black_detection_jitter"]
+    return result
+
+
+def run_case(program_path, settings, seeds, seconds, mix=None, verbose=False, single_core=False, replay=None):     #Run 1 combination of settings for every seed, returns the case with all runs and the average
+    runs = []
+    overrides = dict(settings)
+    if "nominal_speed_feeder" in overrides:                                         #The program copies the nominal feeder speed at startup, before the overrides are set
+        overrides.setdefault("current_speed_feeder", overrides["nominal_speed_feeder"])
+    for seed in seeds:
+        program_output = sys.stdout if verbose else io.StringIO()                  #The prints of the program (rescan data) are only shown if asked for
+        with contextlib.redirect_stdout(program_output):
+            program, stats = simulator.run_program(program_path, seconds, seed, overrides=overrides, mix=mix, single_core=single_core, replay=replay)
+        result = measure(program, stats)
+        result["seed"] = seed
+        runs.append(result)
+        print("  seed {}: {} pins/min, {}% rescans, {} brakes, {} ms arm wait, {}/{} samples/s, {}/{}° jitter".format(seed, result["pins_per_minute"], result["rescan_percent"], result["belt_brakes"],
+              result["average_arm_wait_ms"], result["white_sample_rate"], result["black_sample_rate"], result["white_jitter"], result["black_jitter"]))
+    mean = {}
+    for metric in METRICS: mean[metric] = round(sum([run[metric] for run in runs]) / len(runs), 2)
+    return {"settings": settings, "runs": runs, "mean": mean}
+
+
+def compare(cases, baseline, max_drop):                                             #Return a text line for every metric that got worse by more than max_drop percent
+    regressions = []
+    for case in cases:
+        for old_case in baseline["cases"]:
+            if old_case["settings"] != case["settings"]: continue
+            for metric in REGRESSION_CHECKS:
+                old = old_case["mean"][metric]
+                new = case["mean"][metric]
+                change = (new - old) * REGRESSION_CHECKS[metric]                    #Positive is better
+                if change < 0 and -change > max(abs(old) * max_drop / 100, 0.01):
+                    regressions.append("{} {}: {} -> {}".format(json.dumps(case["settings"], sort_keys=True), metric, old, new))
+    return regressions
+
+
+def parse_value(text):                                                              #"600" becomes 600, "True" becomes True, anything else stays text
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_settings(set_arguments):                                                  #["speed_scanner=600,800", "minimal_distance=1500"] to a list of settings dictionaries
+    names  = []
+    values = []
+    for argument in set_arguments:
+        name, _, options = argument.partition("=")
+        names.append(name.strip())
+        values.append([parse_value(option.strip()) for option in options.split(",")])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def parse_mix(text):                                                                #"Red 3L=2,Tan 1.5L=1" to {"Red 3L": 2, "Tan 1.5L": 1}
+    if text is None: return None
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight) if weight.strip() != "" else 1
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput of a pin sorter program in the simulator")
+    parser.add_argument("program", help="sorting program, for example main_v5_esp.py")
+    parser.add_argument("--seconds", type=float, default=None, help="virtual seconds per run (default 300, or up to the end of the trace with --replay)")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2], help="random seeds, every case runs once per seed")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=V1,V2", help="program setting to override, all combinations are run")
+    parser.add_argument("--replay", default=None, help="recorded sensor trace to run on instead of the simulated pins (see sensor_trace.py)")
+    parser.add_argument("--mix", default=None, help='how often every pin is fed, for example "Red 3L=2,Tan 1.5L=1"')
+    parser.add_argument("--output", default=None, help="JSON file to write the results to, printed if not given")
+    parser.add_argument("--compare", default=None, help="earlier results JSON file to check for regressions")
+    parser.add_argument("--max-drop", type=float, default=5, help="percent a metric may get worse before it is a regression (default 5)")
+    parser.add_argument("--verbose", action="store_true", help="show what the program prints while it runs")
+    parser.add_argument("--single-core", action="store_true", help="let all threads share 1 processor, like on the EV3")
+    arguments = parser.parse_args()
+
+    program_path = os.path.abspath(arguments.program)
+    output_path  = os.path.abspath(arguments.output) if arguments.output else None
+    compare_path = os.path.abspath(arguments.compare) if arguments.compare else None
+    mix          = parse_mix(arguments.mix)
+    replay_path  = os.path.abspath(arguments.replay) if arguments.replay else None
+    if arguments.seconds is None: arguments.seconds = 24 * 3600 if replay_path else 300     #A replay stops by itself at the end of the trace
+    os.chdir(tempfile.mkdtemp(prefix="pinsorter_benchmark_"))                       #The simulated calibrationdata.txt is written here, not next to the program
+
+    cases = []
+    for settings in parse_settings(arguments.set):
+        print("Case {}".format(json.dumps(settings, sort_keys=True)))
+        cases.append(run_case(program_path, settings, arguments.seeds, arguments.seconds, mix, arguments.verbose, arguments.single_core, replay_path))
+    results = {"program": os.path.basename(program_path), "seconds": arguments.seconds, "seeds": arguments.seeds, "mix": mix, "single_core": arguments.single_core,
+               "replay": os.path.basename(replay_path) if replay_path else None, "cases": cases}
+
+    if output_path is None: print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        with open(output_path, "w") as output: json.dump(results, output, indent=2, sort_keys=True)
+    if compare_path is not None:
+        with open(compare_path) as baseline_file: baseline = json.load(baseline_file)
+        regressions = compare(cases, baseline, arguments.max_drop)
+        for regression in regressions: print("REGRESSION " + regression)
+        if len(regressions) > 0: sys.exit(1)
+        print("No regressions against " + os.path.basename(compare_path))
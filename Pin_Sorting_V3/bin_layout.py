@@ -0,0 +1,152 @@
+# Bin layout optimiser for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The swingarm angle of every bin in pins_scanned is chosen by hand. Every time 2 pins after each other go to bins far
+# apart, the swingarm needs more time and the scanning belt is stopped longer to make the gap for it. This tool finds
+# which pin type should get which bin, so the expected swingarm move time per pin is as short as possible for the pins
+# that are really sorted. The bins themselves stay where they are, only the pin types are swapped between them. Pin types
+# that share a bin keep sharing it.
+#
+# What is sorted comes from the EV3 counters, or better from a pin log (log_sorted_pins = True in the program writes
+# the name of every sorted pin to pin_log_file). The counters only tell how often every pin comes, the log also tells
+# which pins follow each other:
+#   python3 bin_layout.py main_v5_esp.py --counts "Red 3L=120,Tan 2L=45,Black 2L=80"
+#   python3 bin_layout.py main_v5_esp.py --log pin_log.txt
+# The new layout is printed and written to bin_layout.txt, 1 "name=angle" line per pin type. Put that file next to the
+# program on the EV3, set use_bin_layout = True, and move the bin contents to the pin types the layout gives them.
+#
+# Finding the best layout is an assignment problem without a fast exact solution, so every start layout (the hand made
+# one and a number of random ones) is improved by swapping 2 bins as long as that makes the move time shorter.
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+
+import simulator
+from benchmark import parse_mix
+from swing_model import SwingModel
+
+
+def load_program(program_path):                                                     #Returns (pins_scanned, swing_model) of the program, with the hand made angles
+    folder = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="pinsorter_layout_"))                          #No bin_layout.txt and no calibrationdata.txt of the real machine here
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            program, stats = simulator.run_program(program_path, 1)               #1 virtual second is enough to build all settings
+    finally:
+        os.chdir(folder)
+    speed, acceleration, actuation = program["turning_arm"].control.limits()
+    return program["pins_scanned"], SwingModel(program["speed_turning_arm"], acceleration)
+
+
+def make_bins(pins_scanned):                                                        #Group the pin types that can be sorted by bin, returns (bin angles, pin names per bin)
+    angles = []
+    names  = []
+    for name in pins_scanned:
+        dataset = pins_scanned[name]["dataset"]
+        if dataset[0] >= dataset[1]: continue                                       #ReScan and Reject never reach the swingarm
+        angle = pins_scanned[name]["angle"]
+        if angle not in angles:
+            angles.append(angle)
+            names.append([])
+        names[angles.index(angle)].append(name)
+    return angles, names
+
+
+def read_log(path):                                                                 #Pin names of a pin log, in the order they were sorted
+    with open(path) as log:
+        return [line.strip() for line in log if line.strip() != ""]
+
+
+def transitions_from_log(sequence, names):                                          #How often a pin of group i was followed by a pin of group j
+    group = {}
+    for number in range(len(names)):
+        for name in names[number]: group[name] = number
+    counts = [[0] * len(names) for number in names]
+    previous = None
+    for name in sequence:
+        if name not in group: continue                                              #ReScan, Reject or a pin type that is not in this program
+        if previous is not None: counts[previous][group[name]] += 1
+        previous = group[name]
+    return counts
+
+
+def transitions_from_counts(counters, names):                                       #Without a log the pins are taken as independent, so i followed by j is count i x count j
+    totals = [sum([counters.get(name, 0) for name in group]) for group in names]
+    return [[first * second for second in totals] for first in totals]
+
+
+def move_time(layout, counts, times):                                               #Average swingarm move time (ms) per pin, layout[group] is the bin number of every group
+    total  = 0
+    weight = 0
+    for first in range(len(layout)):
+        for second in range(len(layout)):
+            count = counts[first][second]
+            if count == 0: continue
+            total  += count * times[layout[first]][layout[second]]
+            weight += count
+    if weight == 0: return 0
+    return total / weight
+
+
+def improve(layout, counts, times):                                                 #Swap 2 bins as long as that makes the move time shorter, returns (layout, move time)
+    layout = list(layout)
+    best   = move_time(layout, counts, times)
+    better = True
+    while better:
+        better = False
+        for first in range(len(layout)):
+            for second in range(first + 1, len(layout)):
+                layout[first], layout[second] = layout[second], layout[first]
+                time = move_time(layout, counts, times)
+                if time < best - 1e-9:
+                    best   = time
+                    better = True
+                else: layout[first], layout[second] = layout[second], layout[first]
+    return layout, best
+
+
+def optimise(angles, counts, swing_model, starts=200, seed=0):                      #Returns (best layout, its move time), the hand made layout is the first start
+    times = [[swing_model.time(abs(first - second)) for second in angles] for first in angles]
+    generator = random.Random(seed)
+    best = improve(list(range(len(angles))), counts, times)
+    for start in range(starts):
+        layout = list(range(len(angles)))
+        generator.shuffle(layout)
+        result = improve(layout, counts, times)
+        if result[1] < best[1] - 1e-9: best = result
+    return best
+
+
+def save_layout(path, angles, names, layout):                                       #1 "name=angle" line per pin type, read by the program at startup
+    with open(path, "w") as output:
+        for group in range(len(names)):
+            for name in names[group]: output.write("{}={}\n".format(name, angles[layout[group]]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the bin of every pin type with the shortest swingarm moves")
+    parser.add_argument("program", help="sorting program, for example main_v5_esp.py")
+    parser.add_argument("--counts", default=None, help='pins sorted per type (the EV3 counters), for example "Red 3L=120,Tan 2L=45"')
+    parser.add_argument("--log", default=None, help="pin log written by the program (log_sorted_pins = True), 1 pin name per line")
+    parser.add_argument("--starts", type=int, default=200, help="random start layouts to improve, besides the hand made one (default 200)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the start layouts")
+    parser.add_argument("--output", default="bin_layout.txt", help="file to write the layout to (default bin_layout.txt)")
+    arguments = parser.parse_args()
+    if arguments.counts is None and arguments.log is None: parser.error("give the sorted pins with --counts or --log")
+
+    pins_scanned, swing_model = load_program(os.path.abspath(arguments.program))
+    angles, names = make_bins(pins_scanned)
+    if arguments.log is not None: counts = transitions_from_log(read_log(arguments.log), names)
+    else:                         counts = transitions_from_counts(parse_mix(arguments.counts), names)
+
+    hand_made = move_time(list(range(len(angles))), counts, [[swing_model.time(abs(first - second)) for second in angles] for first in angles])
+    layout, best = optimise(angles, counts, swing_model, arguments.starts, arguments.seed)
+    for group in sorted(range(len(names)), key=lambda group: angles[layout[group]]):
+        print("{:>5} -> {:>5}   {}".format(angles[group], angles[layout[group]], ", ".join(names[group])))
+    print("Average swingarm move per pin: {:.0f} ms hand made, {:.0f} ms new layout".format(hand_made, best))
+    save_layout(arguments.output, angles, names, layout)
+    print("Saved to " + arguments.output)
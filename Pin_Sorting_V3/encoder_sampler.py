@@ -0,0 +1,79 @@
+# Shared encoder readings for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# On the EV3 every motor.angle() call goes through the motor driver, and the color sensor stages needed one after many
+# of their samples. An EncoderSampler is a sorting stage (see scheduler.py) that reads the angle of 1 motor every few ms,
+# and keeps the last readings with the time they were taken. angle() then only reads the timer: between 2 readings the
+# angle is interpolated, after the newest reading it is extrapolated with the speed of the last readings. Both color
+# sensors get their angles from the same readings, so a pin start and end are measured the same way on both.
+# Only run() writes the readings: it fills the next place in the ring first and counts it afterwards, so a stage in
+# another thread never uses a reading that is half written.
+
+from array import array
+from hardware import StopWatch
+from scheduler import TIME
+
+
+class EncoderSampler:
+    """
+    EncoderSampler
+    The angle of 1 motor at any time, from readings taken at a fixed rate.
+    """
+
+    def __init__(self, motor, interval=5, size=8, span=4):
+        self.motor      = motor
+        self.timer      = StopWatch()
+        self.interval   = interval                                                  #ms between 2 readings
+        self.size       = size                                                      #Readings kept
+        self.span       = span                                                      #Readings back the speed is taken over, more is steadier but follows a speed change later
+        self.times      = array('i', [0] * size)                                    #timer time of every reading
+        self.angles     = array('i', [0] * size)
+        self.count      = 0                                                         #Readings taken, only changed by run()
+        self.valid_from = -1                                                        #Readings at or before this time were taken before the last reset_angle()
+
+    def run(self):                                                                  #Sorting stage that takes a reading every interval ms
+        while True:
+            index = self.count % self.size
+            self.times[index]  = self.timer.time()
+            self.angles[index] = self.motor.angle()
+            self.count += 1                                                         #Only now the reading can be used
+            yield TIME, self.timer, self.times[index] + self.interval
+
+    def _usable(self, count):                                                       #True if there are enough readings since the last reset_angle() to give a speed
+        if count <= self.span: return False
+        return self.times[(count - 1 - self.span) % self.size] > self.valid_from
+
+    def _speed(self, count):                                                        #deg/s over the span readings before reading number count
+        newest = (count - 1) % self.size
+        oldest = (count - 1 - self.span) % self.size
+        if self.times[newest] == self.times[oldest]: return 0
+        return (self.angles[newest] - self.angles[oldest]) * 1000 / (self.times[newest] - self.times[oldest])
+
+    def speed(self):                                                                #deg/s over the last readings
+        count = self.count
+        if self._usable(count) == False: return self.motor.speed()
+        return self._speed(count)
+
+    def angle_at(self, time):                                                       #Motor angle at a timer time, interpolated between the readings or extrapolated from the newest
+        count = self.count
+        if self._usable(count) == False: return self.motor.angle()
+        newest = (count - 1) % self.size
+        if time - self.times[newest] > 3 * self.interval: return self.motor.angle()     #The readings stopped (the stage got no turn), read the motor itself
+        if time >= self.times[newest]:
+            return int(round(self.angles[newest] + self._speed(count) * (time - self.times[newest]) / 1000))
+        for back in range(1, self.size - 1):                                        #Find the 2 readings around the time, the oldest place may be written already
+            before = (count - 1 - back) % self.size
+            after  = (count - back) % self.size
+            if self.times[before] <= self.valid_from: break
+            if self.times[before] <= time:
+                if self.times[after] == self.times[before]: return self.angles[after]
+                part = (time - self.times[before]) / (self.times[after] - self.times[before])
+                return int(round(self.angles[before] + part * (self.angles[after] - self.angles[before])))
+        return self.motor.angle()                                                   #Older than the readings kept, the angle now is the best there is
+
+    def angle(self):                                                                #Motor angle now
+        return self.angle_at(self.timer.time())
+
+    def reset_angle(self, angle=0):                                                 #Reset the motor encoder, the readings taken before are not used anymore
+        self.motor.reset_angle(angle)
+        self.valid_from = self.timer.time()
@@ -0,0 +1,54 @@
+# Feeder speed control for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The feeding belts used to speed up 20 deg/s for every second without a pin, and to jump back to the nominal speed at
+# every pin. The pins that were on their way at the high speed arrive close together, touch, and get rescanned, and
+# after them the belt is empty again. A FeederController sets the feeder speed from the gap between 2 pins at the white
+# sensor instead, in ° of scanning belt motion, so the speed only changes as much as the gaps ask for.
+# The target gap comes from a target pin rate at the scanning speed. Pins can come faster then the swingarm can sort
+# them, the scanning belt is then stopped to make a gap for the swingarm. The part of the time the belt was stopped for
+# it makes the target gap bigger, the same pins per minute reach the swingarm with less stops in between.
+# It is a PI controller: the speed is the nominal speed, changed by gain x the relative gap error plus the integral of it.
+# Without pins the speed is still raised every second, but only with the gain: the gap of an empty stretch keeps growing,
+# and adding it to the integral every second would keep the feeder fast for many pins after the stretch. The gap of the
+# first pin after it is the empty stretch too, so that pin does not change the integral either.
+
+class FeederController:
+    """
+    FeederController
+    PI control of the feeder speed on the measured gaps between the pins at the white sensor.
+    """
+
+    def __init__(self, nominal, minimum, maximum, target_gap, gain=0.5, integral_gain=0.1, stall_rate=0.2):
+        self.nominal       = nominal                                                #deg/s the feeder runs at with the gaps on target
+        self.minimum       = minimum
+        self.maximum       = maximum
+        self.target_gap    = target_gap                                             #° of scanning belt between the starts of 2 pins, at the target pin rate
+        self.gain          = gain                                                   #Part of the nominal speed added per relative gap error
+        self.integral_gain = integral_gain                                          #Part of the relative gap error added to the integral every pin
+        self.stall_rate    = stall_rate                                             #Part of the difference with the new stall fraction that is followed every pin
+        self.integral      = 0
+        self.stalled       = 0                                                      #Part of the time the scanning belt was stopped for the swingarm, averaged over the last pins
+        self.stall_total   = 0                                                      #Stopped ms and time at the last update, the next update uses the difference
+        self.time          = None
+        self.speed         = nominal
+        self.idle          = False                                                  #True after an update without a pin, the next pin closes the empty stretch
+
+    def gap_wanted(self):                                                           #Target gap with the swingarm stops taken in account
+        return self.target_gap / (1 - min(0.5, self.stalled))
+
+    def stall(self, stall_total, now):                                              #Follow the part of the time stopped for the swingarm, stall_total is the ms stopped since the start
+        if self.time is not None and now > self.time:
+            fraction = min(1, (stall_total - self.stall_total) / (now - self.time))
+            self.stalled += (fraction - self.stalled) * self.stall_rate
+        self.stall_total = stall_total
+        self.time        = now
+
+    def update(self, gap, idle=False):                                              #Add 1 measured gap in °, idle if no pin came yet and gap is the belt moved since the last pin. Returns the new feeder speed
+        error = max(-1, min(1, gap / self.gap_wanted() - 1))                        #More then 0 if the pins are to far apart, a very big gap counts as twice the target
+        if idle == False and self.idle == False:
+            self.integral += error * self.integral_gain
+            self.integral  = max(self.minimum / self.nominal - 1, min(self.maximum / self.nominal - 1, self.integral))
+        self.idle      = idle
+        self.speed     = max(self.minimum, min(self.maximum, self.nominal * (1 + self.gain * error + self.integral)))
+        return self.speed
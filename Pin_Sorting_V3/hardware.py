@@ -0,0 +1,21 @@
+# Device layer for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The sorting programs import every EV3 device from here instead of from pybricks directly.
+# On the EV3 brick these are the real pybricks devices. On a computer without pybricks the simulated devices from
+# simulator.py are used, so the sorting logic can run (much faster than real time) without tying up the machine.
+
+try:
+    from pybricks.hubs import EV3Brick
+    from pybricks.ev3devices import Motor, TouchSensor, ColorSensor
+    from pybricks.parameters import Port, Stop, Direction, Button, Color
+    from pybricks.tools import wait, StopWatch
+    from pybricks.media.ev3dev import Font
+    from pybricks.iodevices import UARTDevice
+    from threading import Thread
+    from uartremote import UartRemote
+    SIMULATED = False                                                               #Running on the EV3 brick with the real motors and sensors
+except ImportError:
+    from simulator import (EV3Brick, Motor, TouchSensor, ColorSensor, Port, Stop, Direction, Button, Color,
+                           wait, StopWatch, Font, UARTDevice, Thread, UartRemote)
+    SIMULATED = True                                                                #Running on a computer, every device is simulated
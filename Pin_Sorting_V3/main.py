@@ -1,13 +1,5 @@
 #!/usr/bin/env pybricks-micropython
-from pybricks.hubs import EV3Brick
-from pybricks.ev3devices import (Motor, TouchSensor, ColorSensor,
-                                 InfraredSensor, UltrasonicSensor, GyroSensor)
-from pybricks.parameters import Port, Stop, Direction, Button, Color
-from pybricks.tools import wait, StopWatch, DataLog
-from pybricks.robotics import DriveBase
-from pybricks.media.ev3dev import SoundFile, Image, ImageFile, Font
-from pybricks.messaging import BluetoothMailboxServer, BluetoothMailboxClient, LogicMailbox, NumericMailbox, TextMailbox
-from threading import Thread
+from hardware import *                                                              #EV3 devices from pybricks, or the simulated devices when it runs on a computer
 from random import choice
 from math import fmod
 import sys
@@ -230,7 +222,7 @@ def check_color_white():
         ########## Waiting for the correct position to take a few color samples ##########
         while scanning_belt.angle() < pin_start + white_measuring_distance_start and reversing == False: continue   #Start at a given distance after the pin started for better accuracy
         if reversing == True:                                                       #If the global variable tells that the scanning belt reverses, the new pin detected was incorrect
-            while reversing == True: continue                                       #During reversing stay in this loop waiting for the reversing to be finished
+            while reversing == True: wait(1)                                        #During reversing stay in this loop waiting for the reversing to be finished
             counter = 0
             continue                                                                #This resets back to the top of the "While True: loop", to start scanning for the start of the pin again
         pin_samples = []                                                            #Local variable to save all measurements from each sample
@@ -347,6 +339,7 @@ def check_color_black():
                 ########## This next line will put all the DATA in 1 line on your laptop screen if you run it in Visual Studio Code, so you can see all values that were needed ##########
                 print(pin_list[black_controlled][1], pin_list[black_controlled][2], pin_list[black_controlled][4], pin_list[black_controlled][5], pin_list[black_controlled][7])
                 black_controlled += 1                                               #The global variable is added by 1 now that a pin is completely determined and send to the correct bin
+        else: wait(1)                                                               #No pin to wait for yet, give the other threads time to run
 
 
 def check_result_scans(length_white, length_black, pin_clr):                        #This definition will check if the scanned data matches with any pin data from the dictionary
@@ -1,13 +1,5 @@
 #!/usr/bin/env pybricks-micropython
-from pybricks.hubs import EV3Brick
-from pybricks.ev3devices import (Motor, TouchSensor, ColorSensor,
-                                 InfraredSensor, UltrasonicSensor, GyroSensor)
-from pybricks.parameters import Port, Stop, Direction, Button, Color
-from pybricks.tools import wait, StopWatch, DataLog
-from pybricks.robotics import DriveBase
-from pybricks.media.ev3dev import SoundFile, Image, ImageFile, Font
-from pybricks.messaging import BluetoothMailboxServer, BluetoothMailboxClient, LogicMailbox, NumericMailbox, TextMailbox
-from threading import Thread
+from hardware import *                                                              #EV3 devices from pybricks, or the simulated devices when it runs on a computer
 from random import choice
 from math import fmod
 import sys
@@ -15,9 +7,16 @@ import os
 import math
 import struct
 
-from pybricks.iodevices import UARTDevice
-from utime import ticks_ms
-from uartremote import *
+from pin_classifier import PinTable, fuse_scans, robust_color
+from pin_records import PinStore
+from spsc_queue import SpscQueue
+from scheduler import start_stages, TIME, QUEUE, UNTIL
+from encoder_sampler import EncoderSampler
+from belt_drift import BeltDrift
+from swing_model import SwingModel
+from feeder_control import FeederController
+from background_baseline import BackgroundBaseline
+from sensor_trace import TraceRecorder, RecordedColorSensor, RecordedMotor, CHANNEL_WHITE, CHANNEL_BLACK, CHANNEL_ANGLE
 
 # This program requires LEGO EV3 MicroPython v2.0 or higher.
 # Click "Open user guide" on the EV3 extension tab for more information.
@@ -68,6 +67,7 @@ storage_belt.control.limits( 1200,  3600, 100)
 turning_arm.control.limits(  1200,  3600, 100)                                      #Default    1200,  3600, 100
 nominal_speed_feeder =  250                                                         #Normal speed for the 3 supply conveyors                                                    #Default 250
 maximum_speed_feeder =  900                                                         #Maximal speed for the 3 supply conveyors if there is no pin detected for a long time       #Default 900
+minimum_speed_feeder =  100                                                         #Minimal speed for the 3 supply conveyors if the pins come to close together (feeder_control)  #Default 100
 current_speed_feeder = nominal_speed_feeder                                         #Global variable for the currently used speed for the supplying belts
 speed_scanner        =  600                                                         #Real motor speed (deg/s) used for forward (scanning)                                       #Default 600
 speed_turning_arm    = 1200                                                         #Real motor speed (deg/s) used for the swingarm rotation                                    #Default 1200
@@ -96,20 +96,74 @@ timer_pause      = StopWatch()
 
 ##########~~~~~~~~~~BUILDING GLOBAL VARIABLES~~~~~~~~~~##########
 white_measuring_distance_start =    30                                              #30° motor rotation to start checking the pin color on the white RGB sensor, the start of a pin is inaccurate
-white_samples                  =     5                                              #Take 5x RGB samples with the white background sensor to determine the pin color.
-reject_to_sensor               =  -450                                              #Distance to return the undetermined pin, back to the start of the white sensor
+white_samples                  =     3                                              #Take at least 3x RGB samples with the white background sensor to determine the pin color.
+white_samples_max              =    12                                              #Take more samples while the average is not stable yet, but never more than 12x
+white_color_tolerance          =   0.3                                              #The average is stable when the standard error of R, G and B are all below this
+white_end_margin               =    10                                              #° before the end of the shortest pin in pins_scanned, where the white color sampling always stops
+black_measuring_distance_start =   270                                              #270° motor rotation after the pin started at the white sensor, to take the color sample on the black RGB sensor
+black_samples                  =     5                                              #Take 5x RGB samples spread over the middle of the pin with the black background sensor, the median is used
+black_end_margin               =    15                                              #° before the shortest black length the pin can have, where the last black color sample is taken
+black_end_samples              =     3                                              #Samples in row back in the background range to end a pin on the black sensor, a dark pin can look like the belt for 1 sample
+reject_to_sensor               =  -450                                              #Distance to return the undetermined pin, back to the start of the white sensor (maximum distance if selective_rescan is used)
+selective_rescan               =  True                                              #Only reverse as far as needed to bring the undetermined pin back in front of the white sensor, and keep the other pins data
+rescan_clearance               =    60                                              #° the undetermined pin is put in front of the white sensor when reversing for a selective rescan
+reassociate_tolerance          =    20                                              #° difference allowed between the old and new startpoint at the white sensor, to know it's a pin that was already measured
 reject_to_bin                  =  -800                                              #Distance to return the undetermined pin to the hopper
 max_length_allowed             =   160                                              #Length for a pin to reject it automatically (mostly for 2pins touching each other)
-minimal_distance               =  1500                                              #ms between 2 pins that are not equal. Needed for dropoff before turning the arm away
+minimal_distance               =  1070                                              #ms between 2 pins that are not equal. Needed for dropoff before turning the arm away. The 1500 of the old straight swing time, less the 430 ms the swing model now adds to a long move (speeding up, slowing down and its first settle time)
 calibration_time               = 10000                                              #ms that the calibration function will be running if requested          #Default 60000 (60seconds)
+classify_mode                  = "box"                                              #"box" only accepts a pin inside its dataset limits, "score" also accepts a clear near-miss
+score_max_distance             =   0.5                                              #Maximum normalized distance (in box widths) outside the closest dataset to still accept the pin
+score_min_margin               =   0.4                                              #Minimum distance difference between the closest and 2nd closest pin, else it is a rescan
+fuse_rescans                   =  True                                              #Average the earlier scans of a reversed pin with the new scan, instead of starting from scratch
+fusion_length_tolerance        =    25                                              #Maximum white length difference (°) to accept the rescanned pin as the same pin as before
+record_trace                   = False                                              #Save every scanner color sample and scanning belt angle in trace_file, to replay on a computer (see sensor_trace.py)
+trace_file                     = "trace.bin"                                        #File the trace is written to, it is overwritten at every start
+cooperative_scheduler          = False                                              #Run the 4 sorting stages taking turns in 1 loop (see scheduler.py), instead of a Thread for every stage
+feature_reference_speed        =   600                                              #Scanning belt speed (deg/s) the pins_scanned datasets were measured at, lengths scanned at other speeds are corrected to it
+sensor_delay_ms                =     0                                              #ms the belt position a color reading shows is behind the encoder angle read right after it. Not measured on the EV3 yet, 0 is no correction
+white_integration_ms           =     0                                              #ms of belt motion a white sensor pin length grows by (sensor integration and sampling). Measure it by scanning the same pins at 400 and 800 deg/s
+black_integration_ms           =     0                                              #The same for the black sensor. Scanning the same simulated pins at 400 and 800 deg/s gave 3, 2.8 and 1.3 ms for these 3 settings, but they follow from the 3 ms latency the simulator is given, so they say nothing about the EV3 sensors and 0 stays the default
+sensor_spacing                 =   240                                              #° of scanning belt motion between the white and the black sensor, black_measuring_distance_start is this plus the distance into the pin
+learn_belt_drift               =  True                                              #Learn the sensor spacing and belt slip from the measured pins (see belt_drift.py), and place the color samples with it
+early_double_pin               = False                                              #Reject a pin that is longer then any pin already at the white sensor (2 pins touching), instead of after the black sensor
+double_pin_reverse             =  -600                                              #Distance to return a to long pin from the white sensor to the hopper
+color_space                    = "rgb"                                              #"rgb" compares R G B to the datasets, "chroma" only their chromaticity with the brightness in a tolerance (see pin_classifier.py), for a changing light level
+brightness_tolerance           =  0.15                                              #Part the brightness may be off from the dataset limits in the "chroma" color space
+track_background               = False                                              #Follow the empty belt color of both sensors before every pin, move the background limits and correct the pin colors with it (see background_baseline.py)
+lookahead_slowdown             =  True                                              #Slow the scanning belt down for the pins between the sensors that would reach the swingarm to early, braking is only needed if that is not enough
+minimum_speed_scanner          =   300                                              #Slowest speed (deg/s) the scanning belt is slowed down to, if that is not enough the belt is braked like before
+slowdown_margin                =    30                                              #° before the black sensor from where the belt speed is not changed anymore for a pin, it stays the same while the pin is measured
+learn_swing_time               =  True                                              #Learn how long the swingarm takes to settle after its speed profile from the measured moves (see swing_model.py)
+use_bin_layout                 = False                                              #Take the swingarm angle of every pin from bin_layout_file (made by bin_layout.py from the sorted pins), instead of from pins_scanned
+bin_layout_file                = "bin_layout.txt"                                   #File with 1 "name=angle" line per pin type
+log_sorted_pins                = False                                              #Write the name of every sorted pin to pin_log_file, bin_layout.py finds the best bin layout from it
+pin_log_file                   = "pin_log.txt"                                      #File the sorted pins are added to, it is never emptied by the program
+esp_update_tries               =     3                                              #Times a sorted pin is sent to the ESP without an answer, before that update is dropped
+track_dropoff_belt             =  True                                              #Follow the pins on the swingarm conveyor with its motor angle, instead of with the time since they were dropped on it
+dropoff_distance               =  1500                                              #° swingarm conveyor motion from where a pin is dropped on it to where it falls in its bin
+device_poll_ms                 =    20                                              #ms between the checks of a motor angle or a finished motor move the stages wait for, every check reads the motor
+feeder_control                 =  True                                              #Regulate the feeder speed on the measured gaps between the pins (see feeder_control.py), instead of speeding up every second without a pin
+feeder_target_rate             =    60                                              #Pins per minute the feeder aims for at the white sensor while the scanning belt runs, less when it is stopped for the swingarm
+feeder_gain                    =   0.5                                              #Part of the nominal feeder speed added per relative gap error
+feeder_integral_gain           =   0.1                                              #Part of the relative gap error added to the feeder speed every pin, for a lasting difference
+feeder_stall_rate              =   0.2                                              #How fast the target gap follows the part of the time the scanning belt is stopped for the swingarm, 0 to keep it at the target pin rate
 
 reversing        = False                                                            #Global variable to know if the scanning belt is turning backwards
-black_controlled = 0                                                                #Global counter to see what pin has its data completed by the last sensor (black background color sensor)
+scanning_speed   = speed_scanner                                                    #Global variable with the speed the scanning belt runs forward at now, lower while it is slowed down for the swingarm
+double_pin_request = -1                                                             #Global belt_reversals of 2 touching pins the white sensor found, the black sensor thread reverses for them. -1 if there are none
+arm_stall_ms     = 0                                                                #Global total ms the scanning belt was stopped to make a gap for the swingarm
+belt_reversals   = 0                                                                #Global counter of the scanning belt reversals, a pin measurement that was started before a reversal is not valid
+encoder_reset_at = 0                                                                #Global belt_reversals at the last scanning belt encoder reset, the start angles of older pins can not be compared anymore
 reject_in_row    = 0                                                                #Global counter to see howmany times in row a pin has been undetermined
-arm_turned       = 0                                                                #Global counter to see what pin has been completely put in the storage bins
-pin_list         = []                                                               #Global list with all the scanned pins data
+pin_list         = PinStore(32)                                                     #Global ring with the data of the last 32 pins, pin_list[number] gives the PinRecord of pin number
+black_queue      = SpscQueue(32)                                                    #Pin numbers measured by the white sensor, waiting for the black sensor
+arm_queue        = SpscQueue(32)                                                    #Pin numbers classified by the black sensor thread, waiting for the swingarm
+update_queue     = SpscQueue(32, overwrite=True)                                    #Pin numbers classified by the black sensor thread, waiting to be sent to the ESP. If it is full the oldest update is dropped
+rescan_history   = []                                                               #Global list with the earlier scans [length white, length black, RGB white, RGB black] of the pin being rescanned
 cursor_pos       = 0                                                                #Global position counter to know what line in the menu is selected
 pause_request    = False
+pause_step       = 0                                                                #Global counter of the belts stopped after a pause request, they stop one by one
 
 
 #THE NEXT 2 VARIABLES MIGHT NEED SOME ADJUSTING, DEPENING ON YOUR COLOR SENSORS VALUES, BUT NORMALLY THE CALIBRATION FUNCTION WILL DO THIS AUTOMATICALLY
@@ -197,43 +251,53 @@ print(limits_scanned)
 ##########~~~~~~~~~~UART RECEIVING COMMUNICATION COMMANDS~~~~~~~~~~##########
 def mode_selection(task, state):
     global pause_request
+    global pause_step
     print("task received with", task, state)
     if task == 0:
         if state == 0:
             timer_pause.reset()
             timer_pause.resume()
             pause_request = True
+            pause_step = 0                                                          #The other belts are stopped later by stop_paused_belts(), this function has to return right away
             feeder_belt.stop()
-            while pause_request == True:
-                if timer_pause.time() > 5000:
-                    scanning_belt.stop()
-                    timer_pause.reset()
-                    break
-            while pause_request == True:
-                if timer_pause.time() > 3000:
-                    storage_belt.stop()
-                    break
-            timer_pause.pause()
         elif state == 1:
             timer_pause.pause()
             pause_request = False
-            scanning_belt.run(speed_scanner)
+            scanning_belt.run(scanning_speed)
             storage_belt.run(speed_dropoff_belt)
-            feeder_belt.run(current_speed_feeder)                       #And restart the 3 feeding belts
+            feeder_belt.run(current_speed_feeder * scanning_speed / speed_scanner)      #And restart the 3 feeding belts
 
 
 ur.add_command(mode_selection)
 
-def send_update_scan():
-    global black_controlled
-    last_msg = 0
+def stop_paused_belts():                                                            #After a pause request the scanning belt runs empty for 5 seconds, then the storage belt runs 3 seconds longer
+    global pause_step
+    if pause_step == 0 and timer_pause.time() > 5000:
+        scanning_belt.stop()
+        timer_pause.reset()
+        pause_step = 1
+    elif pause_step == 1 and timer_pause.time() > 3000:
+        storage_belt.stop()
+        timer_pause.pause()
+        pause_step = 2
+
 
+def send_update_scan():                                                             #Sorting stage (see scheduler.py) that sends every classified pin to the ESP, and handles the messages from the ESP
     while True:
-        wait(100)
-        if last_msg < black_controlled:
-            while ur.call("update_scan", '%ss'%len(pin_list[last_msg][7]), pin_list[last_msg][7]) == None: continue
-            last_msg += 1
+        yield QUEUE, update_queue, 100                                              #Wait up to 100ms for a classified pin, then also handle the messages from the ESP
+        number = update_queue.get()
+        if number is not None and pin_list[number].number == number:                #Skip pins whose record was already reused while the ESP did not answer
+            name  = pin_list[number].name                                           #Copied, the record can be reused while the ESP does not answer
+            tries = 1
+            while ur.call("update_scan", '%ss'%len(name), name) == None:            #No answer within the UART timeout
+                if tries == esp_update_tries:
+                    print("ESP not answering, update dropped:", name)
+                    break
+                tries += 1
+                yield
+            if log_sorted_pins == True: pin_log.write(name + "\n")
         ur.process_uart()
+        if pause_request == True: stop_paused_belts()
 
 
 def save_offline_data():                                                            #This definition will save the current background limits to the offline file, if it is called
@@ -274,69 +338,133 @@ def calibration_sensors():
     ev3.screen.draw_text(4, 60, "Calibration is finished                                             ", text_color=Color.BLACK, background_color=Color.WHITE)
 
 
-def check_color_white():                                                            #This definition will handle the color sensor viewing the white background
+def check_color_white():                                                            #Sorting stage (see scheduler.py) that handles the color sensor viewing the white background
     global pin_list
-    global reversing
+    global double_pin_request
     global current_speed_feeder
     global nominal_speed_feeder
+    last_start      = None                                                          #Local variables with the start and reversal count of the last pin, for the gap to the next one
+    last_reversals  = 0
 
     while True:
         counter   = 0                                                               #Local variable to count the amount of samples in row, that are out of range
         pin_start = 0                                                               #Local variable to save the motor angle at which the start of a new pin was first detected
         pin_color = [0, 0, 0]                                                       #Local variable list to save the RGB colors of the current pin measured
+        pin_to_long = False                                                         #Local variable to know if the pin is longer then any pin, 2 pins touching
         timer_feed_speed.reset()                                                    #Reset the timer to 0 everytime a new pin started detection, or a pin is succesfully measured
         
+        previous_angle  = None                                                      #Local variables with the angle and background excess of the last sample, the pin edge is between that sample and the next
+        previous_excess = 0
         ########## Waiting for the start of a new pin ##########
         while True:
-            if counter == 0 and timer_feed_speed.time() > 1000 and current_speed_feeder < maximum_speed_feeder and pause_request == False: #Every second no pin is detected and feeding not maxed out yet, do this
+            if feeder_control == True and counter == 0 and timer_feed_speed.time() > 1000 and pause_request == False and last_start is not None and last_reversals == belt_reversals:
+                timer_feed_speed.reset()                                            #Every second no pin is detected, the gap is at least as big as the belt moved since the last pin
+                if belt_encoder.angle() - last_start > feeder_controller.gap_wanted():
+                    current_speed_feeder = feeder_controller.update(belt_encoder.angle() - last_start, True)
+                    feeder_belt.run(current_speed_feeder * scanning_speed / speed_scanner)
+            elif feeder_control == False and counter == 0 and timer_feed_speed.time() > 1000 and current_speed_feeder < maximum_speed_feeder and pause_request == False: #Every second no pin is detected and feeding not maxed out yet, do this
                 timer_feed_speed.reset()                                            #Reset the timer back to 0 (to start counting back to 1000ms)
                 current_speed_feeder += 20                                          #Set the desired speed for the feeding belt 20°/s higher then before
-                feeder_belt.run(current_speed_feeder)                               #Send the new speed to the motor controlling the 3 feeding conveyor belts
+                feeder_belt.run(current_speed_feeder * scanning_speed / speed_scanner)      #Send the new speed to the motor controlling the 3 feeding conveyor belts
             white_scan = color_white.rgb()                                          #Take a sample from the color sensor with a white background
-            trigger = False                                                         #Local variable used to see if any value will be out of range
-            for x in range(3):
-                if white_scan[x] < limits_scanned[x] or white_scan[x] > limits_scanned[x + 3]:  #Check if any of the 3 color values is out of background color range
-                    if trigger == False and counter == 0: pin_start = scanning_belt.angle()     #Save the motor angle at which the first RGB value out of nominal range is detected
-                    if trigger == False: trigger = True
-            if trigger == True: counter += 1                                        #If any of the 3 colors was out of range count up by 1
+            scan_angle = belt_encoder.angle()                                       #Motor angle of this sample
+            if track_background == True: white_baseline.add(white_scan)             #The samples before the pin are the background baseline
+            excess = background_excess(white_scan, 0)                               #More then 0 if any of the 3 color values is out of background color range
+            if excess > 0:
+                if counter == 0:
+                    pin_start   = edge_angle(previous_angle, previous_excess, scan_angle, excess)   #Save the motor angle at which the pin came in front of the sensor, between the last 2 samples
+                    start_speed = belt_encoder.speed()                              #Real belt speed at the start of the pin
+                counter += 1                                                        #If any of the 3 colors was out of range count up by 1
             elif counter > 0: counter = 0                                           #If none of them was out of range reset the in row detected back to 0
             if counter == 3: break                                                  #If 3 times in row a value was out of range a pin is detected (To make sure it's not a single faulty value)
-        current_speed_feeder = nominal_speed_feeder                                 #Set the desired speed for the feeding belt back to nominal
+            previous_angle  = scan_angle
+            previous_excess = excess
+            yield                                                                   #Let the other stages have a turn after every sample
+        if track_background == True: white_baseline.update()                       #The empty belt right before this pin is the background now
+        pin_start = edge_position(pin_start, start_speed)                           #Where the pin start really was, the sensor showed it a bit late
+        reversals_at_start = belt_reversals                                         #Remember the reversal count, if it changes during the measurement the data is thrown away
+        if reversing == True:                                                       #Seen while the belt reverses, it is not a new pin and the old start angles may not be valid yet
+            yield UNTIL, lambda: reversing == False
+            continue
+        known = measured_before(pin_start)                                          #After a reversal, pins that were already measured pass the white sensor again at the same encoder angle
+        if feeder_control == True:                                                  #Set the feeding belt speed for the gap to the last pin
+            feeder_controller.stall(arm_stall_ms, timer_pin_accept.time())
+            if last_start is not None and last_reversals == reversals_at_start: current_speed_feeder = feeder_controller.update(pin_start - last_start)
+            last_start     = pin_start
+            last_reversals = reversals_at_start
+        else: current_speed_feeder = nominal_speed_feeder                           #Set the desired speed for the feeding belt back to nominal
         if pause_request == False:                                                  #TODO check if this pause updat works fine
-            feeder_belt.run(current_speed_feeder)                                       #Send the new speed to the motor controlling the 3 feeding conveyor belts
+            feeder_belt.run(current_speed_feeder * scanning_speed / speed_scanner)  #Send the new speed to the motor controlling the 3 feeding conveyor belts, slower while the scanning belt is slowed down
         ########## Waiting for the correct position to take a few color samples ##########
-        while scanning_belt.angle() < pin_start + white_measuring_distance_start and reversing == False: continue   #Start at a given distance after the pin started for better accuracy
-        if reversing == True:                                                       #If the global variable tells that the scanning belt reverses, the new pin detected was incorrect
-            while reversing == True: continue                                       #During reversing stay in this loop waiting for the reversing to be finished
-            counter = 0
-            continue                                                                #This resets back to the top of the "While True: loop", to start scanning for the start of the pin again
-        pin_samples = []                                                            #Local variable to save all measurements from each sample
-        for x in range(white_samples):                                              #Take the amount of samples required
-            white_scan = color_white.rgb()
-            pin_samples.extend(white_scan)                                          #Add the RGB result to the end of the list
-        for x in range(white_samples):
-            for y in range(3):                                                      #Add for each color, the result values together
-                pin_color[y] += pin_samples[(3 * x) + y]
-        for x in range(3):                                                          #Divide by the amount of sample for 1 single RGB result that is the average from all the samples
-            pin_color[x] = round(pin_color[x] / white_samples, 1)                   #Round down to 1 decimal to prevent 8.0000000000001
+        if known is None:                                                           #A pin found back keeps its first measurement, only its end is needed
+            sample_angle = pin_start + white_measuring_distance_start * belt_drift.slip + integration_shift(start_speed, white_integration_ms)   #Start at a given distance after the pin started for better accuracy, past the smeared edge
+            yield UNTIL, lambda: sensor_position() >= sample_angle or reversing == True or belt_reversals != reversals_at_start
+            if reversing == True or belt_reversals != reversals_at_start:           #If the scanning belt reverses or reversed, the new pin detected was incorrect
+                yield UNTIL, lambda: reversing == False                             #During reversing wait for the reversing to be finished
+                continue                                                            #This resets back to the top of the "While True: loop", to start scanning for the start of the pin again
+            samples      = 0                                                        #Local variables with the running average and sum of squared differences of R G B (Welford)
+            sample_m2    = [0, 0, 0]
+            pin_variance = [0, 0, 0]                                                #Local variable list with the variance of 1 sample, per R G B
+            sample_end   = pin_start + shortest_white_length - white_end_margin     #Sensor position at which even the shortest pin is about to end
+            while True:                                                             #Take samples until the average is stable, or there is no more room on the pin
+                white_scan = color_white.rgb()
+                samples += 1
+                stable = samples > 1
+                for y in range(3):
+                    delta = white_scan[y] - pin_color[y]
+                    pin_color[y] += delta / samples
+                    sample_m2[y] += delta * (white_scan[y] - pin_color[y])
+                    if stable == True and sample_m2[y] / (samples - 1) / samples > white_color_tolerance * white_color_tolerance: stable = False    #Variance of the average still to big
+                if samples >= white_samples and stable == True: break               #Clean pin, enough samples
+                if samples >= white_samples_max or sensor_position() >= sample_end: break
+                yield
+            for x in range(3):
+                pin_color[x] = round(pin_color[x], 1)                               #Round down to 1 decimal to prevent 8.0000000000001
+                if samples > 1: pin_variance[x] = round(sample_m2[x] / (samples - 1), 2)
+            if track_background == True: pin_color = white_baseline.correct(pin_color) #The colors the pin would have had with the calibrated background
         ########## Waiting for the end of the new pin ##########
+        previous_angle = None
         while True:
             white_scan = color_white.rgb()                                          #Take a sample from the color sensor with a white background
-            trigger = 0                                                             #All 3 values have to be in range, so reset every loop the local variable to 0 triggers
-            for x in range(3):
-                if white_scan[x] < limits_scanned[x] or white_scan[x] > limits_scanned[x + 3]: continue
-                else: trigger += 1                                                  #For each R G & B that are back in range trigger is added by 1
-            if trigger == 3: break                                                  #If all 3 the RGB values are back in nominal range, end the pin length
-        pin_end = scanning_belt.angle()                                             #Save the motor angle at which the first RGB value back in nominal range is detected
+            scan_angle = belt_encoder.angle()
+            excess = background_excess(white_scan, 0)
+            if excess <= 0: break                                                   #If all 3 the RGB values are back in nominal range, end the pin length
+            if early_double_pin == True and scan_angle > pin_start + white_length_allowed:  #Longer then any pin can be, stop scanning for the end
+                pin_to_long = True
+                break
+            previous_angle  = scan_angle
+            previous_excess = excess
+            yield
+        end_speed = belt_encoder.speed()
+        pin_end = edge_position(edge_angle(previous_angle, previous_excess, scan_angle, excess), end_speed)   #Save the motor angle at which the pin left the sensor, between the last 2 samples
+        if reversals_at_start != belt_reversals: continue                          #The belt reversed during the measurement, so there is no new data
+        if pin_to_long == True:                                                     #2 pins touching, throw them back in the hopper before they reach the black sensor
+            if feeder_control == True: current_speed_feeder = feeder_controller.update(0)   #The pins touched, a gap of 0
+            double_pin_request = reversals_at_start                                 #Only the black sensor thread reverses the belt, so a rescan or a gap brake is never overridden
+            yield UNTIL, lambda: double_pin_request < 0 and reversing == False      #Wait for the black sensor thread to finish the reversal
+            continue
+        pin_length = normalized_length(pin_end - pin_start, (start_speed + end_speed) / 2, white_integration_ms)    #The length it would have had at the speed the datasets were made at
         ########## Pin DATA; Startpoint, length and white color values ##########
-        pin_list.append([pin_start, pin_end - pin_start, pin_color])                #Store the first pin data; Startpoint , length and white color values
+        if known is not None:                                                       #Store the pin again with the data of its first measurement, in belt order with the new pins
+            record = pin_list[known]
+            record.generation = -1                                                  #Found back, the old record is not used anymore
+            number = pin_list.add(pin_start, record.length_white, list(record.color_white), reversals_at_start, record.samples_white, list(record.variance_white))
+        else: number = pin_list.add(pin_start, pin_length, pin_color, reversals_at_start, samples, pin_variance)   #Store the first pin data; Startpoint , length and white color values
+        if black_queue.put(number) == False:                                        #Hand the pin to the black sensor thread, if its queue is full wait for room
+            print("Black sensor queue full, waiting")
+            yield UNTIL, lambda: black_queue.put(number)
 
 
-def check_color_black():                                                            #This definition will handle the color sensor viewing the black background
-    global black_controlled
+def check_color_black():                                                            #Sorting stage (see scheduler.py) that handles the color sensor viewing the black background
     global pin_list
     global reversing
+    global belt_reversals
     global reject_in_row
+    global rescan_history
+    global arm_stall_ms
+    global encoder_reset_at
+    global double_pin_request
+    previous_record = None                                                          #Local variable with the last pin that was sent to the swingarm
     
     while True:
         counter     = 0                                                             #Local variable to count the amount of samples in row, that are out of range
@@ -344,110 +472,277 @@ def check_color_black():
         pin_color   = [0, 0, 0]                                                     #Local variable list to save the RGB colors of the current pin measured
         pin_to_long = False                                                         #Local variable to know if a pin is to long and might fall off the scanning belt unwanted
         
-        if len(pin_list) > black_controlled:                                        #Only start this if data has been added for a pin that has not been scanned yet by black background sensor
+        yield UNTIL, lambda: len(black_queue) > 0 or double_pin_request >= 0        #Wait for a pin measured by the white sensor, or 2 touching pins it found
+        if double_pin_request >= 0:                                                 #This thread is the only one that reverses the scanning belt
+            if double_pin_request == belt_reversals:                                #Not reversed since the pins were measured, they are still on their way to this sensor
+                pins_scanned["Reject"]["counter"] += 1                              #Add 1 pin to the Rejected counter
+                scanning_belt.brake()
+                reversing = True                                                    #Change the global variable so all functions know that the scanning belt will reverse
+                belt_reversals += 1                                                 #Every pin measured before this makes it back in front of the white sensor, and is found back there
+                scanning_belt.run_angle(900, double_pin_reverse, wait=False)        #Reverse the scanning belt at full speed to throw the pins back in the hopper
+                yield UNTIL, scanning_belt.control.done, device_poll_ms             #The other stages go on while the belt reverses
+                reversing = False
+                set_scanning_speed(speed_scanner)                                   #Start the scanning belt at the scanning speed again
+            double_pin_request = -1                                                 #Handled, the white sensor thread goes on
+            continue
+        number = black_queue.get()
+        if number is not None and pin_list[number].generation == belt_reversals:    #A pin measured before the last reversal is skipped, it passes the white sensor again and gets a new number
+            record = pin_list[number]                                               #The PinRecord of this pin, the white sensor already filled in its part
+            if lookahead_slowdown == True and reversing == False:
+                belt_speed = planned_scanning_speed(previous_record, record)        #The pins between the sensors arrive at the swingarm as late as needed, the belt keeps moving
+                if belt_speed is not None and belt_speed != scanning_speed: set_scanning_speed(belt_speed)
+            previous_angle  = None                                                  #Local variables with the angle and background excess of the last sample
+            previous_excess = 0
             ########## Waiting for the start of a new pin in front of the black sensor ##########
             while True:
+                if double_pin_request >= 0: break                                   #2 touching pins at the white sensor, the belt reverses first and this pin comes back
                 black_scan = color_black.rgb()                                      #Take a sample from the color sensor with a black background
-                trigger = False                                                     #Reset the local variable trigger to False
-                for x in range(3):
-                    if black_scan[x] < limits_scanned[x + 6] or black_scan[x] > limits_scanned[x + 9]:  #Check if any of the 3 color values is out of background color range
-                        if trigger == False and counter == 0: pin_start = scanning_belt.angle()         #Save the motor angle at which the first RGB value out of nominal range is detected
-                        if trigger == False: trigger = True                         #If one of the values is out of range trigger the whole set as 1 set out of range 
-                if trigger == True: counter += 1                                    #Count the sets in row that are out of range
+                scan_angle = belt_encoder.angle()
+                if track_background == True: black_baseline.add(black_scan)
+                excess = background_excess(black_scan, 6)                           #More then 0 if any of the 3 color values is out of background color range
+                if excess > 0:
+                    if counter == 0:
+                        pin_start   = edge_angle(previous_angle, previous_excess, scan_angle, excess)   #Save the motor angle at which the pin came in front of the sensor
+                        start_speed = belt_encoder.speed()
+                    counter += 1                                                    #Count the sets in row that are out of range
                 elif counter > 0: counter = 0                                       #If there was a set out of range, but not now again, it was a false trigger, and resets
                 if counter == 3: break                                              #If one/more of the 3 RGB values has been out of nominal range in row, a pin is detected
-            ########## Waiting for the correct position to take a color sample ##########
-            while scanning_belt.angle() < pin_list[black_controlled][0] + 270: continue                 #Start at a given distance after the pin started at the white sensor, for better accuracy
-            pin_color_tuple = color_black.rgb()                                     #Take 1 color sample from the pin
-            for x in range(3): pin_color[x] = pin_color_tuple[x]                    #Change from tuple to list, to be able to add the values to the data list later
+                previous_angle  = scan_angle
+                previous_excess = excess
+                yield                                                               #Let the other stages have a turn after every sample
+            if double_pin_request >= 0: continue
+            if track_background == True: black_baseline.update()
+            pin_start = edge_position(pin_start, start_speed)
+            ########## Taking color samples spread over the middle of the pin ##########
+            burst_start   = record.start_white + belt_drift.spacing + (black_measuring_distance_start - sensor_spacing) * belt_drift.slip + integration_shift(start_speed, black_integration_ms)   #Start at a given distance after the pin started at the black sensor, for better accuracy
+            burst_end     = pin_start + pin_table.shortest_black(record.length_white) - black_end_margin   #End before the pin can end, the pins that fit the white length tell how short it can be
+            burst_samples = black_samples if burst_end > burst_start else 1         #No room on the pin, only 1 sample like before
+            burst_step    = (burst_end - burst_start) / max(1, burst_samples - 1)
+            pin_samples = []
+            for x in range(burst_samples):
+                burst_angle = burst_start + x * burst_step + belt_encoder.speed() * sensor_delay_ms / 1000
+                yield UNTIL, lambda: belt_encoder.angle() >= burst_angle or double_pin_request >= 0
+                if double_pin_request >= 0: break
+                black_scan = color_black.rgb()
+                if x > 0 and background_excess(black_scan, 6) <= 0: break           #The pin already ended, the samples taken are all there is
+                pin_samples.append(black_scan)
+            if double_pin_request >= 0: continue
+            pin_color, pin_spread = robust_color(pin_samples)                       #Median per R G B, 1 glare spike does not change it
+            if track_background == True: pin_color = black_baseline.correct(pin_color)
             ########## Waiting for the end of the new pin ##########
+            previous_angle = None
+            counter        = 0                                                      #Samples in row back in the background range
             while True:
                 black_scan = color_black.rgb()                                      #Take a sample from the color sensor with a black background
-                trigger = 0                                                         #All 3 values have to be in range, so reset every loop the local variable to 0 triggers
-                for x in range(3):
-                    if black_scan[x] < limits_scanned[x + 6] or black_scan[x] > limits_scanned[x + 9]: continue
-                    else: trigger += 1                                              #For each R G & B that are back in range trigger is added by 1
-                if trigger == 3: break                                              #If all 3 the RGB values are back in nominal range, end the pin length
-                if scanning_belt.angle() > pin_start + max_length_allowed:          #If the end of the pin is not detected for a to long time, stop scanning for the end
-                    pin_to_long = True                                              #Save to a local variable that the pin was to long (2touching etc)
-                    break                                                           #Stop the scanning
-            pin_end = scanning_belt.angle()                                         #Save the motor angle at which the first RGB value back in nominal range is detected
+                scan_angle = belt_encoder.angle()
+                excess = background_excess(black_scan, 6)
+                if double_pin_request >= 0: break
+                if excess <= 0:
+                    if counter == 0:                                                #The pin left the sensor between the last sample on it and this one, if the next samples are background too
+                        end_angle = edge_angle(previous_angle, previous_excess, scan_angle, excess)
+                        end_speed = belt_encoder.speed()
+                    counter += 1
+                    if counter == black_end_samples: break                          #If all 3 the RGB values are back in nominal range a few samples in row, end the pin length
+                else:
+                    counter = 0
+                    if scan_angle > pin_start + max_length_allowed:                 #If the end of the pin is not detected for a to long time, stop scanning for the end
+                        pin_to_long = True                                          #Save to a local variable that the pin was to long (2touching etc)
+                        break                                                       #Stop the scanning
+                previous_angle  = scan_angle
+                previous_excess = excess
+                yield
+            if double_pin_request >= 0: continue                                    #The belt reverses for 2 touching pins, so there is no new data
             if pin_to_long == True:                                                 #If the pin was determined to long perform the next task
-                pin_end = 999999999                                                 #Save pin end encoder position to a very great value
-                pin_to_long = False
-            ########## Pin DATA added;        Startpoint, length,              black color values and distanse between the pin starts for both sensors
-            pin_list[black_controlled].extend([pin_start, pin_end - pin_start, pin_color, pin_start - pin_list[black_controlled][0]])
-            #Example: [3032, 99, [12.0, 9.4, 6.4], 3269, 80, (20, 16, 19), 237]         
-            #[3032               , 99          , [12.0, 9.4, 6.4], 3269               , 80          , (20, 16, 19)    , 237]
-            #[startpos in ° white, length white, color from white, startpos in ° black, length black, color from black, startpoints distance]
+                end_speed = belt_encoder.speed()
+                pin_end   = 999999999                                               #Save pin end encoder position to a very great value
+            else: pin_end = edge_position(end_angle, end_speed)                     #Save the motor angle at which the pin left the sensor
+            ########## Pin DATA added;        Startpoint, length, black color values and distanse between the pin starts for both sensors (all fields in pin_records.py)
+            record.start_black    = pin_start
+            record.length_black   = normalized_length(pin_end - pin_start, (start_speed + end_speed) / 2, black_integration_ms)
+            record.start_distance = round(pin_start - record.start_white, 1)
+            if learn_belt_drift == True: belt_drift.add(record.start_distance)     #Every pin measured on both sensors shows the sensor spacing again
+            for x in range(3):
+                record.color_black[x]  = pin_color[x]
+                record.spread_black[x] = pin_spread[x]
+            #Example: start white 3032, length white 99, color white [12.0, 9.4, 6.4], start black 3269, length black 80, color black [20, 16, 19], start distance 237
 
             ########## Read the type of pin being scanned by using all the DATA ##########
-            result_pin = check_result_scans(pin_list[black_controlled][1], pin_list[black_controlled][4], pin_list[black_controlled][2] + pin_list[black_controlled][5])
-            pin_list[black_controlled].extend([result_pin])                         #Add the name of the determined pin to the data pin list
+            pin_features = [record.length_white, record.length_black] + record.color_white + record.color_black
+            if fuse_rescans == False or (len(rescan_history) > 0 and math.fabs(pin_features[0] - rescan_history[-1][0]) > fusion_length_tolerance):
+                rescan_history = []                                                 #Not the same pin that was reversed (or fusion is off), so start with only this scan
+            if pin_to_long == True: pin_variances = [0] * len(pin_features)         #Not a scan of 1 pin, it is kept out of the average so the next pass is not spoiled by it
+            else:
+                rescan_history.append(pin_features)
+                pin_features, pin_variances = fuse_scans(rescan_history)            #Average all scans of this pin, with only 1 scan it's just the scan itself
+            result_pin, result_score, result_margin = check_result_scans(pin_features[0], pin_features[1], pin_features[2:])
+            record.name = result_pin                                                #Add the name of the determined pin to the pin record
 
             ########## If the pin is undetermined, perform a rescan, if 3rd scan still fails, bin it ##########
             if result_pin == "ReScan":                                              #If the name of the pin is Rescan, perform the rescan job and show on laptop the data
-                print(pin_list[black_controlled][1], pin_list[black_controlled][2], pin_list[black_controlled][4], pin_list[black_controlled][5], pin_list[black_controlled][7])
+                print(record.length_white, record.color_white, record.length_black, record.color_black, record.spread_black, record.name, result_score, result_margin, len(rescan_history), pin_variances)
                 reject_in_row += 1                                                  #Every rescan done in row adds 1 up.
                 scanning_belt.brake()                                               #Brake the scanning belt to prevent the undetermined pin to fall off onto the swingarm
                 reversing = True                                                    #Change the global variable so all functions know that the scanning belt will reverse
-                if reject_in_row < 3:                                               #If less then 3 rescans in row are performed;
+                belt_reversals += 1                                                 #Every pin measured before this makes it back in front of the white sensor, and is found back there
+                if reject_in_row < 3 and selective_rescan == True:                  #Only bring the undetermined pin back in front of the white sensor, the pins behind it keep their data
                     pins_scanned[result_pin]["counter"] += 1                        #Add 1 pin to the Rescanned counter
-                    scanning_belt.run_angle(900, reject_to_sensor)                  #Reverse the scanning belt at full speed so the undetermined pin can be rescanned
-                else:                                                               #If it's the 3rd undetermined in row;
-                    pins_scanned["Reject"]["counter"] += 1                          #Add 1 pin to the Rejected counter
-                    scanning_belt.run_angle(900, reject_to_bin)                     #Reverse the scanning belt at full speed to throw all pins back in the bulk hopper
-                    reject_in_row = 0                                               #Reset the variable rescans in row back to 0
-                del pin_list[black_controlled:]                                     #Delete all started pin data for the not fully finished pins (including last undetermined)
-                scanning_belt.reset_angle(0)                                        #Reset the scanning belt encoder to 0 to prevent bugs with pin length
+                    rescan_target = max(record.start_white - rescan_clearance, scanning_belt.angle() + reject_to_sensor)
+                    scanning_belt.run_target(900, rescan_target, wait=False)        #Reverse at full speed, untill the pin start is the clearance distance before the white sensor
+                    yield UNTIL, scanning_belt.control.done, device_poll_ms         #The other stages go on while the belt reverses
+                else:
+                    if reject_in_row < 3:                                           #If less then 3 rescans in row are performed;
+                        pins_scanned[result_pin]["counter"] += 1                    #Add 1 pin to the Rescanned counter
+                        scanning_belt.run_angle(900, reject_to_sensor, wait=False)  #Reverse the scanning belt at full speed so the undetermined pin can be rescanned
+                    else:                                                           #If it's the 3rd undetermined in row;
+                        pins_scanned["Reject"]["counter"] += 1                      #Add 1 pin to the Rejected counter
+                        scanning_belt.run_angle(900, reject_to_bin, wait=False)     #Reverse the scanning belt at full speed to throw all pins back in the bulk hopper
+                        reject_in_row = 0                                           #Reset the variable rescans in row back to 0
+                        rescan_history = []                                         #The pin is back in the hopper, its scans are not needed anymore
+                    yield UNTIL, scanning_belt.control.done, device_poll_ms
+                    belt_encoder.reset_angle(0)                                     #Reset the scanning belt encoder to 0 to prevent bugs with pin length
+                    encoder_reset_at = belt_reversals                               #The pins measured before can not be found back by their start angle
                 reversing = False                                                   #Change the global variable so all functions know that the scanning belt will run again
-                scanning_belt.run(speed_scanner)                                    #Start the scanning belt at the scanning speed again
+                set_scanning_speed(speed_scanner)                                   #Start the scanning belt at the scanning speed again
             else: 
                 pins_scanned[result_pin]["counter"] += 1                            #Add 1 pin to the determined pin counter
                 reject_in_row = 0
+                scans_fused   = len(rescan_history)                                 #Save how many scans were needed for this pin
+                rescan_history = []
                 ########## Check if the gap between pins is sufficient for the swingarm to be able to rotate ##########
-                if black_controlled != 0:                                           #If it's the first pin after startup, there is no other pin to calculate the difference
-                    swing_angle = math.fabs(pins_scanned[pin_list[black_controlled - 1][7]]["angle"] - pins_scanned[pin_list[black_controlled][7]]["angle"]) #Calculate swingarm motion distance
-                    time_needed_swing = swing_angle / speed_turning_arm * 1000      #Calculate swingarm motion time needed
+                if previous_record is not None:                                     #If it's the first pin after startup, there is no other pin to calculate the difference
+                    swing_angle = math.fabs(pins_scanned[previous_record.name]["angle"] - pins_scanned[record.name]["angle"])   #Calculate swingarm motion distance
+                    time_needed_swing = swing_model.time(swing_angle)               #Calculate swingarm motion time needed, speeding up, slowing down and settling included
                     if swing_angle != 0:                                            #If the determined pin will not be put in the same bin;
-                        if time_needed_swing + minimal_distance > timer_pin_accept.time() - pin_list[black_controlled - 1][8]:      #If the pins are scanned to close to eachother, create gap
+                        if track_dropoff_belt == True:                              #The gap in ° of swingarm conveyor motion, it does not grow while that belt is paused
+                            gap_position = previous_record.drop_position + (time_needed_swing + minimal_distance) * speed_dropoff_belt / 1000
+                            gap_ready    = lambda: storage_belt.angle() >= gap_position
+                        else: gap_ready  = lambda: timer_pin_accept.time() >= previous_record.drop_time + time_needed_swing + minimal_distance
+                        if gap_ready() == False:                                    #If the pins are scanned to close to eachother, create gap
                             scanning_belt.brake()                                   #Stop the scanning belt
                             feeder_belt.stop()                                      #Stop the feeding belts
-                        while time_needed_swing + minimal_distance > timer_pin_accept.time() - pin_list[black_controlled - 1][8]:
-                            continue                                                #Wait for the gap to be big enough
-                        scanning_belt.run(speed_scanner)                            #If the gap is big enough restart the scanning belt
-                        if pause_request == False:                                  #TODO this has been added later, check functionality
-                            feeder_belt.run(current_speed_feeder)                       #And restart the 3 feeding belts
+                            stall_start = timer_pin_accept.time()
+                            yield UNTIL, gap_ready, device_poll_ms                  #Wait for the gap to be big enough
+                            arm_stall_ms += timer_pin_accept.time() - stall_start   #The feeder controller feeds less if the belt is stopped often
+                        set_scanning_speed(scanning_speed)                          #If the gap is big enough restart the scanning belt, and the 3 feeding belts
                 else: time_needed_swing = 2000                                      #Global variable making for the first pin sorted at startup  
 
                 current_time = timer_pin_accept.time()                              #At this time the pin gets dropped off the scanning belt, and the time is saved
-                pin_list[black_controlled].extend([current_time, int(current_time + (1500 / speed_dropoff_belt * 1000) - time_needed_swing)])   #Save the data when to start the swingarm motion
+                record.drop_time   = current_time
+                record.swing_time  = int(current_time + (dropoff_distance / speed_dropoff_belt * 1000) - time_needed_swing)     #Save the data when to start the swingarm motion
+                record.drop_position  = storage_belt.angle()                        #The same on the swingarm conveyor, the swingarm starts the move time before the pin falls at the speed_dropoff_belt speed
+                record.swing_position = record.drop_position + dropoff_distance - time_needed_swing * speed_dropoff_belt / 1000
+                if previous_record is not None:                                     #But never before the previous pin fell in its bin, the conveyor may run slower or have stopped in between
+                    record.swing_position = max(record.swing_position, previous_record.drop_position + dropoff_distance)
+                record.score       = result_score                                   #Save how sure the classification was, 0 score is inside the dataset limits
+                record.margin      = result_margin
+                record.scans_fused = scans_fused                                    #Save howmany scans were averaged, and the variance of each feature between those scans
+                record.variances   = pin_variances
                 ########## This next line will put all the DATA in 1 line on your laptop screen if you run it in Visual Studio Code, so you can see all values that were needed ##########
-                #print(pin_list[black_controlled][1], pin_list[black_controlled][2], pin_list[black_controlled][4], pin_list[black_controlled][5], pin_list[black_controlled][7])
-                black_controlled += 1                                               #The global variable is added by 1 now that a pin is completely determined and send to the correct bin
-                #send_update_scan(result_pin)
+                #print(record.length_white, record.color_white, record.length_black, record.color_black, record.name)
+                previous_record = record
+                if arm_queue.put(number) == False:                                  #Hand the pin to the swingarm thread, if its queue is full wait for room
+                    print("Swingarm queue full, waiting")
+                    yield UNTIL, lambda: arm_queue.put(number)
+                update_queue.put(number)                                            #And to the ESP update thread, this never waits, sorting goes on if the ESP does not answer
+                if scanning_speed != speed_scanner and len(black_queue) == 0: set_scanning_speed(speed_scanner)    #No pin left to slow down for
 
 
-def check_result_scans(length_white, length_black, pin_clr):                        #This definition will check if the scanned data matches with any pin data from the dictionary
-    for x in pins_scanned:                                                          #It will automatically loop for every pin defined in the dictionary, so you can add your own pins at line 116
-        if  pins_scanned[x]["dataset"][ 0] <  length_white <  pins_scanned[x]["dataset"][ 1] and pins_scanned[x]["dataset"][ 2] <  length_black <  pins_scanned[x]["dataset"][ 3] and \
-            pins_scanned[x]["dataset"][ 4] <= pin_clr[0]   <= pins_scanned[x]["dataset"][ 5] and pins_scanned[x]["dataset"][ 6] <= pin_clr[1]   <= pins_scanned[x]["dataset"][ 7] and \
-            pins_scanned[x]["dataset"][ 8] <= pin_clr[2]   <= pins_scanned[x]["dataset"][ 9] and pins_scanned[x]["dataset"][10] <= pin_clr[3]   <= pins_scanned[x]["dataset"][11] and \
-            pins_scanned[x]["dataset"][12] <= pin_clr[4]   <= pins_scanned[x]["dataset"][13] and pins_scanned[x]["dataset"][14] <= pin_clr[5]   <= pins_scanned[x]["dataset"][15]: return x
-    return "ReScan"                                                                 #If it does not match with any pin, it will send back that a rescan is needed
+def background_excess(scan, first):                                                 #How far the color value furthest out of the background limits is out, 0 or less if all 3 are in. first is 0 for white, 6 for black
+    excess = -100
+    for x in range(3):
+        if limits_live[first + x] - scan[x] > excess:     excess = limits_live[first + x] - scan[x]
+        if scan[x] - limits_live[first + x + 3] > excess: excess = scan[x] - limits_live[first + x + 3]
+    return excess
 
 
-def rotate_turning_arm():                                                           #This definition handles the swingarm motion
-    global black_controlled
-    global pin_list
-    global arm_turned
+def edge_angle(angle_before, excess_before, angle_after, excess_after):             #Motor angle where a pin edge crossed the background limit, between the samples before and after it
+    if angle_before is None or excess_before == excess_after: return angle_after    #No sample before the edge (or no edge, a pin that was to long), use the sample after it
+    part = excess_before / (excess_before - excess_after)                           #The excess goes through 0 at the edge, straight between both samples
+    return round(angle_before + part * (angle_after - angle_before), 1)
+
+
+def edge_position(angle, speed):                                                    #Belt position of an edge seen at a motor angle, the color reading shows the belt sensor_delay_ms earlier
+    return round(angle - speed * sensor_delay_ms / 1000, 1)
+
+
+def sensor_position():                                                              #Belt position the color sensors see right now
+    return belt_encoder.angle() - belt_encoder.speed() * sensor_delay_ms / 1000
+
+
+def measured_before(pin_start):                                                     #Number of a pin measured before the last reversal that started at the same encoder angle, None for a new pin
+    for number in range(max(0, len(pin_list) - pin_list.capacity), len(pin_list)):
+        record = pin_list[number]
+        if record.name is None and encoder_reset_at <= record.generation < belt_reversals and math.fabs(record.start_white - pin_start) <= reassociate_tolerance: return number
+    return None                                                                     #The undetermined pin itself has its name, it is measured again
+
+
+def integration_shift(speed, integration_ms):                                       #° a pin edge is smeared out more at a belt speed (deg/s) then at feature_reference_speed
+    return (speed - feature_reference_speed) * integration_ms / 1000
+
+
+def set_scanning_speed(speed):                                                      #Run the scanning belt forward at a speed, the feeding belts slow down with it so the pins do not get closer together
+    global scanning_speed
+    scanning_speed = speed
+    scanning_belt.run(speed)
+    if pause_request == False:                                                      #TODO this has been added later, check functionality
+        feeder_belt.run(current_speed_feeder * speed / speed_scanner)
+
+
+def planned_scanning_speed(previous_record, record):                                #Scanning belt speed at which record and the pins behind it in black_queue reach the swingarm no sooner then it can take them, None to keep the speed
+    if previous_record is None or previous_record.name not in pins_scanned: return None     #No pin went to the swingarm yet, or its record was reused already
+    if track_dropoff_belt == True: elapsed = (storage_belt.angle() - previous_record.drop_position) * 1000 / speed_dropoff_belt
+    else:                          elapsed = timer_pin_accept.time() - previous_record.drop_time
+    belt_angle = belt_encoder.angle()
+    if record.start_white + belt_drift.spacing - belt_angle < slowdown_margin: return None      #The pin is already at the black sensor
+    speed    = speed_scanner
+    bins     = [pins_scanned[previous_record.name]["angle"]]                        #Swingarm angles the pin before can go to, the last one put in arm_queue has its bin already
+    drop_end = None                                                                 #Encoder angle at which the pin before drops, None for the one already dropped
+    for index in range(-1, len(black_queue)):
+        if index >= 0:
+            number = black_queue.peek(index)
+            if number is None: break
+            record = pin_list[number]                                               #The pins behind it, in the order they reach the swingarm
+            if record.generation != belt_reversals: continue                        #Measured before the last reversal, it comes back with a new number
+        pins = pin_table.white_candidates(record.length_white, record.color_white)
+        if len(pins) == 0: break                                                    #No pin fits, it is rescanned and the belt reverses anyway
+        next_bins  = [pins_scanned[pin_table.names[pin]]["angle"] for pin in pins]
+        swing      = min([math.fabs(a - b) for a in bins for b in next_bins])       #The shortest move it can need, the belt is never slowed more then needed
+        end        = record.start_white + belt_drift.spacing + record.length_white  #The pin drops when its end passed the black sensor
+        if swing > 0:
+            gap = swing_model.time(swing) + minimal_distance                        #ms needed between the 2 drops
+            if drop_end is None:
+                if gap > elapsed: speed = min(speed, (end - belt_angle) * 1000 / (gap - elapsed))
+            else: speed = min(speed, (end - drop_end) * 1000 / gap)                 #The pins keep their spacing on the belt, at a lower speed there is more time between them
+        bins     = next_bins
+        drop_end = end
+    return int(max(minimum_speed_scanner, speed))
+
+
+def normalized_length(length, speed, integration_ms):                               #Pin length measured at a belt speed (deg/s), changed to the length at feature_reference_speed
+    return round(length - integration_shift(speed, integration_ms), 1)
+
+
+def check_result_scans(length_white, length_black, pin_clr):                        #This definition will check if the scanned data matches with any pin data from the dictionary, returns (name, score, margin)
+    if classify_mode == "score":                                                    #Near-misses are given to the closest pin if it is clearly closer than the next one
+        return pin_table.score(length_white, length_black, pin_clr, score_max_distance, score_min_margin)
+    return pin_table.classify(length_white, length_black, pin_clr), 0, 0            #Only the pins with a fitting white length are checked, first match in dictionary order wins. "ReScan" if none fits
+
+
+def rotate_turning_arm():                                                           #Sorting stage (see scheduler.py) that handles the swingarm motion
+    timer_swing = StopWatch()                                                       #Own timer to measure the swingarm moves
 
     while True:
-        if arm_turned < black_controlled:                                           #If a new pin is succesfully detected, and has its dropoff time added, start the waiting
-            while timer_pin_accept.time() < pin_list[arm_turned][9]: wait(25)       #Wait untill the time is reached that the swinging should start
-            turning_arm.run_target(speed_turning_arm, pins_scanned[pin_list[arm_turned][7]]["angle"], then=Stop.HOLD, wait=True)    #Move to the correct position with the swingarm
-            arm_turned += 1                                                         #Complete the swingarm motion for this pin
-        wait(100)                                                                   #Wait block to make the rest of the program run faster
+        yield QUEUE, arm_queue, 100                                                 #Wait for a pin that is succesfully detected, and has its dropoff time added
+        number = arm_queue.get()
+        if number is not None:
+            record = pin_list[number]
+            if track_dropoff_belt == True: yield UNTIL, lambda: storage_belt.angle() >= record.swing_position, device_poll_ms    #Wait untill the pin is close enough to its bin that the swinging should start
+            else: yield TIME, timer_pin_accept, record.swing_time                   #Wait untill the time is reached that the swinging should start
+            swing_angle = math.fabs(pins_scanned[record.name]["angle"] - turning_arm.angle())
+            timer_swing.reset()
+            turning_arm.run_target(speed_turning_arm, pins_scanned[record.name]["angle"], then=Stop.HOLD, wait=False)   #Move to the correct position with the swingarm
+            yield UNTIL, turning_arm.control.done, device_poll_ms
+            if learn_swing_time == True and swing_angle > turning_arm.control.target_tolerances()[1]: swing_model.add(swing_angle, timer_swing.time())   #A move of only a few ° is done right away, it says nothing about the settling
 
 
 def homing_swingarm():                                                              #This definiton will find the homing position for the swingarm, so it knows where every bin is
@@ -518,12 +813,6 @@ def clear_screen():
     ev3.screen.draw_text(103, 114, "Mr Jos creation", text_color=Color.BLACK, background_color=Color.WHITE)     #Write text on the EV3 screen on the XY grid
 
     
-##########~~~~~~~~~~CREATING MULTITHREADS~~~~~~~~~~##########
-sub_white_scanner = Thread(target=check_color_white)                                #Creating a multithread so the definition can run at the same time as the main program, if it's called
-sub_black_scanner = Thread(target=check_color_black)
-sub_turning_arm   = Thread(target=rotate_turning_arm)
-sub_send_update   = Thread(target=send_update_scan)
-
 ##########~~~~~~~~~~MAIN PROGRAM~~~~~~~~~~##########
 clear_screen()
 while True:
@@ -545,13 +834,31 @@ while True:
 clear_screen()
 homing_swingarm()
 clear_screen()
-sub_white_scanner.start()                                                           #Starting the multithread
-sub_black_scanner.start()
-sub_turning_arm.start()
-sub_send_update.start()
+if use_bin_layout == True and bin_layout_file in os.listdir():                      #Put the pins in the bins the layout file gives them
+    with open(bin_layout_file) as retrieve_layout:
+        for layout_line in retrieve_layout.read().splitlines():
+            layout_name, _, layout_angle = layout_line.rpartition("=")
+            if layout_name in pins_scanned: pins_scanned[layout_name]["angle"] = int(layout_angle)
+pin_table = PinTable(pins_scanned, color_space, brightness_tolerance)               #Compile the pin datasets once into a fast lookup table, used by every scan
+shortest_white_length = pin_table.edges[0]                                          #Lowest white length limit of all pins, the white color samples are taken before a pin this short ends
+white_length_allowed  = max(max_length_allowed, pin_table.edges[-1])                #Length at the white sensor for a pin to reject it early, never shorter then the longest pin in pins_scanned
+belt_drift     = BeltDrift(sensor_spacing)                                          #Global running estimate of the sensor spacing and belt slip, only the black sensor thread adds to it
+swing_model    = SwingModel(speed_turning_arm, turning_arm.control.limits()[1])     #Global swingarm move time, with the acceleration from the limits above, only the swingarm thread adds to it
+if record_trace == True:                                                            #From here on every sample the scanner threads take is saved
+    recorder      = TraceRecorder(trace_file, limits_scanned)
+    color_white   = RecordedColorSensor(color_white, recorder, CHANNEL_WHITE)
+    color_black   = RecordedColorSensor(color_black, recorder, CHANNEL_BLACK)
+    scanning_belt = RecordedMotor(scanning_belt, recorder, CHANNEL_ANGLE)
+if log_sorted_pins == True: pin_log = open(pin_log_file, "a")                      #Kept open while sorting, it is flushed with the screen update
+belt_encoder   = EncoderSampler(scanning_belt)                                      #Reads the scanning belt angle every 5ms, the color sensor stages get their angles from it
+limits_live    = list(limits_scanned)                                               #Background limits the pin detection uses, the calibrated ones moved by the background baselines
+white_baseline = BackgroundBaseline(limits_scanned, limits_live, 0, 16, 10, 10)      #Keeps 16 readings, skips the 10 newest and the first 10 after a pin (about 6° at the white sensor sample rate)
+black_baseline = BackgroundBaseline(limits_scanned, limits_live, 6, 12,  4,  3)      #The black sensor takes less readings per °
+feeder_controller = FeederController(nominal_speed_feeder, minimum_speed_feeder, maximum_speed_feeder, speed_scanner * 60 / feeder_target_rate, feeder_gain, feeder_integral_gain, feeder_stall_rate)   #Target gap in ° of scanning belt for the target pin rate
+sorting_stages = [belt_encoder.run(), check_color_white(), check_color_black(), rotate_turning_arm(), send_update_scan()]   #Creating the sorting stages, they run at the same time as the main program
+start_stages(sorting_stages, cooperative_scheduler)                                 #Starting them in 1 Thread together, or in a Thread each
 storage_belt.run(speed_dropoff_belt)
-feeder_belt.run(current_speed_feeder)
-scanning_belt.run(speed_scanner)
+set_scanning_speed(speed_scanner)                                                   #The scanning belt and the 3 feeding belts
 
 onscreen_counter_line = "{}: {} {} "                                                #Create a text line with 3 blank spots, to be filled in later
 while True:                                                                         #This loop will write on the EV3 screen all the sorted pin amounts (every 10seconds refreshes)
@@ -567,6 +874,8 @@ while True:
         pos_screen += 1
     ev3.screen.draw_text(4, 103, onscreen_counter_line.format("Total pins sorted", counter_pins, "pins"), text_color=Color.BLACK, background_color=Color.WHITE)
     if counter_pins > 0: ev3.screen.draw_text(4, 114, onscreen_counter_line.format("% rescans", int(rescanned_pins / counter_pins * 100), "%  "), text_color=Color.BLACK, background_color=Color.WHITE)
+    if record_trace == True: recorder.flush()                                       #Write the recorded samples of the last 5 seconds to the trace file
+    if log_sorted_pins == True: pin_log.flush()
     wait(5000)                                                                     #Every 5 seconds the screen stats are updated, if refreshed to fast it will use to much processing power
 
 
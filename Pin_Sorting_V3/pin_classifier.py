@@ -0,0 +1,203 @@
+# Pin classification helpers for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The pins_scanned dictionary stays the place where pins are defined and counted, this file only turns it into
+# a faster lookup. At startup the datasets are compiled into one flat array with 16 bounds per pin type, and an
+# interval index on the white length. A scan then only checks the few pin types whose white length window holds
+# the measured length, instead of walking the complete dictionary for every pin.
+# For scans that fit no box at all, score() measures how far the scan is from every box, so a near-miss that is
+# clearly closest to 1 pin type can still be sorted instead of being rescanned.
+# white_candidates() gives the pin types a pin can still be after the white sensor only, so the swingarm can be planned
+# before the black sensor measured it.
+# fuse_scans() averages the scans of a pin that was reversed for a rescan, so every pass adds information.
+# robust_color() turns a burst of color samples into 1 color, a single glare spike does not move the result.
+# With color_space "chroma" only the chromaticity of a color (R : G : B) has to fit the limits, the brightness may be off.
+# More or less light on a sensor (ambient light, a sensor warming up) changes R, G and B by the same factor. So a scan
+# fits when R, G and B of 1 sensor can be scaled by 1 factor within brightness_tolerance into the dataset limits.
+# The limits of a pin become a cone around its box instead of the box itself, and 2 pins of the same color with a
+# different brightness (dark and light gray) stay apart as long as the tolerance is smaller then their difference.
+
+from array import array
+
+DATASET_SIZE = 16                                                                   #Values in every "dataset" list: 4 length limits, 6x2 RGB limits
+
+
+class PinTable:
+    """
+    PinTable
+    Compiled version of the pins_scanned dictionary, gives the same answer as checking every pin in dictionary order.
+    """
+
+    def __init__(self, pins_scanned, color_space="rgb", brightness_tolerance=0):
+        self.names       = []                                                       #Pin names, in the same order the dictionary is looped
+        self.bounds      = array('d')                                               #All datasets behind each other, pin number n starts at n * DATASET_SIZE
+        self.chroma      = color_space == "chroma"                                  #True if only the chromaticity of the colors has to fit, see the top of this file
+        self.tolerance   = brightness_tolerance                                     #Part the brightness may be off in the "chroma" color space
+        for name in pins_scanned:
+            self.names.append(name)
+            for value in pins_scanned[name]["dataset"]:
+                self.bounds.append(value)
+        self._build_index()
+
+    def _build_index(self):                                                         #Split the white length axis in pieces, and save what pins are possible in each piece
+        bd = self.bounds
+        valid = []                                                                  #Pins with an empty white length window (ReScan, Reject) can never match
+        edges = []
+        for pin in range(len(self.names)):
+            low  = bd[pin * DATASET_SIZE]
+            high = bd[pin * DATASET_SIZE + 1]
+            if low < high:
+                valid.append(pin)
+                if low  not in edges: edges.append(low)
+                if high not in edges: edges.append(high)
+        edges.sort()
+        self.edges = edges
+        #Region 2*i is the open piece before edges[i], region 2*i+1 is exactly edges[i], the last region is after the last edge
+        regions = []
+        for region in range(2 * len(edges) + 1):
+            candidates = []
+            for pin in valid:
+                low  = bd[pin * DATASET_SIZE]
+                high = bd[pin * DATASET_SIZE + 1]
+                if region % 2 == 1:                                                 #A single length value, that is exactly on an edge
+                    edge = edges[region // 2]
+                    if low < edge < high: candidates.append(pin)
+                elif 0 < region < 2 * len(edges):                                   #The open piece between 2 edges, the window has to cover it completely
+                    if low <= edges[region // 2 - 1] and high >= edges[region // 2]: candidates.append(pin)
+            regions.append(tuple(candidates))                                       #Candidates stay in dictionary order, so the first match is the same as before
+        self.regions = regions
+
+    def candidates(self, length_white):                                             #Return the pin numbers whose white length window holds this length
+        edges = self.edges
+        low   = 0
+        high  = len(edges)
+        while low < high:                                                           #Binary search for the amount of edges smaller or equal to the length
+            middle = (low + high) // 2
+            if edges[middle] <= length_white: low = middle + 1
+            else: high = middle
+        if low > 0 and edges[low - 1] == length_white: return self.regions[2 * low - 1]
+        return self.regions[2 * low]
+
+    def white_candidates(self, length_white, color_white):                          #Return the pin numbers that fit the white length and white colors, before the black sensor measured the pin
+        bd    = self.bounds
+        found = []
+        for pin in self.candidates(length_white):
+            o = pin * DATASET_SIZE
+            if self.chroma == True:
+                if self._fits_scaled(o + 4, color_white, 0): found.append(pin)
+            elif bd[o + 4] <= color_white[0] <= bd[o + 5] and bd[o + 6] <= color_white[1] <= bd[o + 7] and bd[o + 8] <= color_white[2] <= bd[o + 9]:
+                found.append(pin)
+        return found
+
+    def shortest_black(self, length_white):                                        #Lowest black length limit of the pins that can have this white length, 0 if no pin can
+        shortest = 0
+        for pin in self.candidates(length_white):
+            low = self.bounds[pin * DATASET_SIZE + 2]
+            if shortest == 0 or low < shortest: shortest = low
+        return shortest
+
+    def _fits_scaled(self, o, pin_clr, first):                                      #True if 1 sensor's R G B (pin_clr[first:first+3]) fit the limits from bounds[o] on, after 1 brightness factor
+        bd   = self.bounds
+        low  = 1 - self.tolerance                                                   #Range of factors that is left, every color makes it smaller
+        high = 1 + self.tolerance
+        for x in range(3):
+            value = pin_clr[first + x]
+            if value > 0:
+                if bd[o + 2 * x] / value > low:      low  = bd[o + 2 * x] / value
+                if bd[o + 2 * x + 1] / value < high: high = bd[o + 2 * x + 1] / value
+            elif bd[o + 2 * x] > 0: return False                                    #No factor makes 0 reach the lower limit
+        return low <= high
+
+    def _scaled(self, o, pin_clr, first):                                           #1 sensor's R G B scaled as close to the brightness of the limits from bounds[o] on as the tolerance allows
+        bd     = self.bounds
+        total  = pin_clr[first] + pin_clr[first + 1] + pin_clr[first + 2]
+        middle = (bd[o] + bd[o + 1] + bd[o + 2] + bd[o + 3] + bd[o + 4] + bd[o + 5]) / 2
+        factor = middle / total if total > 0 else 1
+        factor = min(1 + self.tolerance, max(1 - self.tolerance, factor))
+        return [pin_clr[first + x] * factor for x in range(3)]
+
+    def matches(self, pin, length_black, pin_clr):                                  #Check all limits except the white length, which the index already checked
+        bd = self.bounds
+        o  = pin * DATASET_SIZE
+        if self.chroma == True:
+            return bd[o + 2] < length_black < bd[o + 3] and self._fits_scaled(o + 4, pin_clr, 0) and self._fits_scaled(o + 10, pin_clr, 3)
+        return bd[o +  2] <  length_black < bd[o +  3] and \
+               bd[o +  4] <= pin_clr[0]   <= bd[o +  5] and bd[o +  6] <= pin_clr[1] <= bd[o +  7] and \
+               bd[o +  8] <= pin_clr[2]   <= bd[o +  9] and bd[o + 10] <= pin_clr[3] <= bd[o + 11] and \
+               bd[o + 12] <= pin_clr[4]   <= bd[o + 13] and bd[o + 14] <= pin_clr[5] <= bd[o + 15]
+
+    def classify(self, length_white, length_black, pin_clr):                        #Return the name of the first pin that matches all data, or "ReScan"
+        for pin in self.candidates(length_white):
+            if self.matches(pin, length_black, pin_clr): return self.names[pin]
+        return "ReScan"
+
+    def distance(self, pin, length_white, length_black, pin_clr):                  #Normalized distance from the scan to the box of 1 pin, 0 if it is inside the box
+        bd = self.bounds
+        o  = pin * DATASET_SIZE
+        if self.chroma == True: pin_clr = self._scaled(o + 4, pin_clr, 0) + self._scaled(o + 10, pin_clr, 3)  #Measure from the brightness the tolerance allows
+        total = 0
+        for feature in range(8):                                                    #2 lengths and 6 RGB values, each with a lower and upper limit
+            if   feature == 0: value = length_white
+            elif feature == 1: value = length_black
+            else:              value = pin_clr[feature - 2]
+            low   = bd[o + 2 * feature]
+            high  = bd[o + 2 * feature + 1]
+            width = high - low
+            if width < 1: width = 1                                                 #Some limits are a single value, 1 step outside them is a full box width
+            if   value < low:  total += ((low - value) / width) ** 2
+            elif value > high: total += ((value - high) / width) ** 2
+        return total ** 0.5
+
+    def score(self, length_white, length_black, pin_clr, max_distance, min_margin): #Return (name, distance, margin), name is "ReScan" if the best pin is not clear enough
+        best_pin      = -1
+        best_distance = -1
+        next_distance = -1
+        for pin in range(len(self.names)):
+            if self.bounds[pin * DATASET_SIZE] >= self.bounds[pin * DATASET_SIZE + 1]: continue     #Skip ReScan and Reject, they have no box
+            distance = self.distance(pin, length_white, length_black, pin_clr)
+            if best_pin < 0 or distance < best_distance:
+                next_distance = best_distance
+                best_pin      = pin
+                best_distance = distance
+            elif next_distance < 0 or distance < next_distance:
+                next_distance = distance
+        if best_pin < 0: return "ReScan", 0, 0
+        if next_distance >= 0: margin = next_distance - best_distance
+        else:                  margin = float("inf")                                #Only 1 pin defined, there is no runner-up to be confused with
+        name = self.classify(length_white, length_black, pin_clr)                   #A scan that fits a box keeps the same answer as the box classification
+        if name != "ReScan": return name, 0, margin
+        if best_distance <= max_distance and margin >= min_margin: return self.names[best_pin], best_distance, margin
+        return "ReScan", best_distance, margin
+
+
+def fuse_scans(scans):                                                              #Combine several scans of the same pin, returns (average per feature, variance per feature)
+    count     = len(scans)
+    features  = []
+    variances = []
+    for feature in range(len(scans[0])):                                            #Scans are [length white, length black, R G B white, R G B black]
+        total = 0
+        for scan in scans: total += scan[feature]
+        average = total / count
+        spread  = 0
+        for scan in scans: spread += (scan[feature] - average) ** 2
+        features.append(round(average, 1))                                          #Round down to 1 decimal to prevent 8.0000000000001
+        variances.append(round(spread / count, 2))
+    return features, variances
+
+
+def median(values):                                                                 #Middle value, or the average of the 2 middle values
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1: return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def robust_color(samples):                                                          #Combine RGB samples of 1 pin, returns (median per color, median absolute deviation per color)
+    color  = []
+    spread = []
+    for x in range(3):
+        values = [sample[x] for sample in samples]
+        middle = median(values)
+        color.append(middle)
+        spread.append(median([abs(value - middle) for value in values]))
+    return color, spread
@@ -0,0 +1,82 @@
+# Pin record storage for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# Every pin on the machine gets a PinRecord, filled in by the white sensor, the black sensor and the classification, and
+# read by the swingarm. The records are made once at startup and reused in a ring, so the memory stays the same no matter
+# how long the sorter runs. A pin keeps the number it got when it was added (0, 1, 2, ...), the threads hand these numbers
+# to each other with the queues in spsc_queue.py, and pin_list[number] gives the record.
+# Only the last "capacity" numbers are kept, which has to be more than the pins between the white sensor and the bins.
+
+class PinRecord:
+    """
+    PinRecord
+    All data of 1 pin, in named fields instead of list positions.
+    """
+
+    __slots__ = ("start_white", "length_white", "color_white", "samples_white", "variance_white", "start_black", "length_black",
+                 "color_black", "spread_black", "start_distance", "name", "drop_time", "swing_time", "drop_position", "swing_position", "score", "margin", "scans_fused", "variances",
+                 "generation", "number")
+
+    def __init__(self):
+        self.color_white    = [0, 0, 0]                                             #Made once, the values are copied in
+        self.variance_white = [0, 0, 0]
+        self.color_black    = [0, 0, 0]
+        self.spread_black   = [0, 0, 0]
+        self.clear()
+
+    def clear(self):
+        self.start_white    = 0                                                     #Motor angle at which the pin started at the white sensor
+        self.length_white   = 0                                                     #Length in ° seen by the white sensor
+        self.samples_white  = 0                                                     #Color samples the white sensor averaged
+        self.start_black    = 0                                                     #Motor angle at which the pin started at the black sensor
+        self.length_black   = 0
+        self.start_distance = 0                                                     #Difference between both start angles
+        self.name           = None                                                  #Pin name after classification
+        self.drop_time      = 0                                                     #timer_pin_accept time the pin was dropped on the swingarm conveyor
+        self.swing_time     = 0                                                     #timer_pin_accept time the swingarm should start turning for this pin
+        self.drop_position  = 0                                                     #Swingarm conveyor motor angle at which the pin was dropped on it
+        self.swing_position = 0                                                     #Swingarm conveyor motor angle at which the swingarm should start turning for this pin
+        self.score          = 0                                                     #Distance outside the dataset limits, 0 if inside
+        self.margin         = 0                                                     #Distance difference to the 2nd best pin
+        self.scans_fused    = 0                                                     #Amount of scans averaged, more then 1 after a rescan
+        self.variances      = None                                                  #Variance of every feature over those scans
+        self.generation     = 0                                                     #belt_reversals when the white measurement started, older pins are measured again
+        self.number         = -1                                                    #Pin number this record holds now, a thread with an older number sees the record was reused
+        for x in range(3):
+            self.color_white[x]    = 0
+            self.variance_white[x] = 0                                              #Variance of 1 white color sample, per R G B
+            self.color_black[x]    = 0
+            self.spread_black[x]   = 0                                              #Median distance of the black color samples to their median, per R G B
+
+
+class PinStore:
+    """
+    PinStore
+    Fixed amount of PinRecords used as a ring, addressed with pin numbers that keep counting up.
+    """
+
+    def __init__(self, capacity=32):
+        self.records  = [PinRecord() for x in range(capacity)]
+        self.capacity = capacity
+        self.tail     = 0                                                           #Number the next added pin gets, only the white scanner adds pins
+
+    def __len__(self):
+        return self.tail
+
+    def __getitem__(self, number):
+        return self.records[number % self.capacity]
+
+    def add(self, start_white, length_white, color_white, generation, samples_white=0, variance_white=None):     #Fill the oldest record with a new pin, returns its number
+        number = self.tail
+        record = self.records[number % self.capacity]
+        record.clear()
+        record.start_white   = start_white
+        record.length_white  = length_white
+        record.samples_white = samples_white
+        record.generation    = generation
+        record.number        = number
+        for x in range(3): record.color_white[x] = color_white[x]
+        if variance_white is not None:
+            for x in range(3): record.variance_white[x] = variance_white[x]
+        self.tail += 1
+        return number
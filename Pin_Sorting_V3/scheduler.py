@@ -0,0 +1,82 @@
+# Cooperative scheduler for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The EV3 has only 1 processor core. With a Thread for every stage of the sorter, a thread that waits in a
+# "while ...: continue" loop takes processor time away from the threads that are reading a color sensor.
+# Here every stage is a generator, that yields where it has to wait and tells what it waits for:
+#   yield                           give the other stages a turn, then go on
+#   yield TIME, timer, time         until timer.time() is at least time
+#   yield QUEUE, queue, ms          until something is in the queue (spsc_queue.py), or at most ms
+#   yield UNTIL, check              until check() returns True
+#   yield UNTIL, check, ms          the same, but check() is only called every ms, for a check that reads a motor or sensor
+# run_cooperative runs all stages in 1 loop, every stage that can go on gets 1 turn per round, so both color sensors
+# are sampled at a steady rate. It reads its own timer once per round for all TIME and QUEUE waits, so a TIME wait
+# has to be on a timer that is not paused or reset while the stage waits. run_stage runs 1 stage in its own Thread and
+# does each wait itself, like the programs with a Thread for every stage always did. start_stages starts them either way.
+
+from hardware import wait, StopWatch, Thread
+
+
+TIME  = 1
+QUEUE = 2
+UNTIL = 3
+
+
+def run_stage(stage):                                                               #Run 1 stage in the calling thread, every wait is done right here
+    timer = StopWatch()
+    for request in stage:
+        if request is None: continue                                                #The other threads get their turn from the thread switching itself
+        kind = request[0]
+        if kind == TIME:
+            remaining = request[2] - request[1].time()
+            while remaining > 0:                                                    #Sleep the whole time that is left, the processor is free for the other threads
+                wait(remaining)
+                remaining = request[2] - request[1].time()
+        elif kind == QUEUE:
+            end = timer.time() + request[2]
+            while len(request[1]) == 0 and timer.time() < end: wait(1)
+        elif kind == UNTIL:
+            interval = request[2] if len(request) > 2 else 1
+            while not request[1](): wait(interval)
+
+
+def run_cooperative(stages):                                                        #Run all stages in the calling thread, until every stage has ended
+    timer    = StopWatch()
+    requests = [None] * len(stages)                                                 #What every stage waits for, None if it can go on
+    ends     = [0] * len(stages)                                                    #timer time at which the TIME or QUEUE wait of every stage is over
+    running  = len(stages)
+    while running > 0:
+        now = timer.time()                                                          #1 timer reading for all waits of this round
+        for index in range(len(stages)):
+            stage = stages[index]
+            if stage is None: continue                                              #This stage has ended
+            request = requests[index]
+            if request is not None:                                                 #Check if the wait is over, else the next stage gets its turn
+                kind = request[0]
+                if kind == TIME:
+                    if now < ends[index]: continue
+                elif kind == QUEUE:
+                    if len(request[1]) == 0 and now < ends[index]: continue
+                elif kind == UNTIL:
+                    if now < ends[index]: continue
+                    if not request[1]():
+                        if len(request) > 2: ends[index] = now + request[2]         #Not checked again before its interval is over
+                        continue
+            try:
+                request = next(stage)                                               #Run the stage up to its next yield
+            except StopIteration:
+                stages[index] = None
+                running -= 1
+                continue
+            requests[index] = request
+            if request is None: continue
+            if   request[0] == TIME:  ends[index] = now + request[2] - request[1].time()   #The time on the timer of the stage, changed to a time on the own timer
+            elif request[0] == QUEUE: ends[index] = now + request[2]
+            elif request[0] == UNTIL: ends[index] = now                             #Checked right in the next round
+
+
+def start_stages(stages, cooperative=False):                                        #Start the stage generators, all in 1 Thread together or every stage in its own Thread
+    if cooperative == True:
+        Thread(target=run_cooperative, args=(list(stages),)).start()
+    else:
+        for stage in stages: Thread(target=run_stage, args=(stage,)).start()
@@ -0,0 +1,140 @@
+# Sensor trace recording for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# With record_trace = True in the sorting program, every color_white.rgb(), color_black.rgb() and scanning_belt.angle()
+# sample is saved with its time in ms in a small binary file. The samples are packed in a buffer that is made once at
+# the start, and only written to the file when the buffer is full or flush() is called, so recording does not slow the
+# scanning down with a file write for every sample.
+# On a computer, read_trace() loads the file again, and the simulator can replay it: the program then sees exactly the
+# recorded samples, so a field problem or 2 versions of the classification can be checked on identical input.
+#     python3 simulator.py main_v5_esp.py --replay trace.bin
+#
+# File layout: header "<4sB12B" (b"PTRC", version, the 12 limits_scanned values used while recording), followed by
+# records "<IBi" (time in ms since the first sample, channel, value). The value of a color channel is R + G*256 + B*65536,
+# the value of the angle channel is the motor angle.
+
+import struct
+from hardware import StopWatch
+try:
+    from _thread import allocate_lock
+except ImportError:
+    from threading import Lock as allocate_lock
+
+TRACE_MAGIC   = b"PTRC"
+TRACE_VERSION = 1
+HEADER_FORMAT = "<4sB12B"
+RECORD_FORMAT = "<IBi"
+HEADER_SIZE   = struct.calcsize(HEADER_FORMAT)
+RECORD_SIZE   = struct.calcsize(RECORD_FORMAT)
+
+CHANNEL_WHITE = 0                                                                   #color_white.rgb()
+CHANNEL_BLACK = 1                                                                   #color_black.rgb()
+CHANNEL_ANGLE = 2                                                                   #scanning_belt.angle()
+
+
+def pack_rgb(rgb):                                                                  #3 color values (0-100) in 1 number
+    return rgb[0] | (rgb[1] << 8) | (rgb[2] << 16)
+
+
+def unpack_rgb(value):
+    return (value & 255, (value >> 8) & 255, (value >> 16) & 255)
+
+
+class TraceRecorder:
+    """
+    TraceRecorder
+    Saves samples of several threads in 1 preallocated buffer, and writes the buffer to the trace file in batches.
+    """
+
+    def __init__(self, path, limits, batch_records=8192):
+        self.buffer   = bytearray(RECORD_SIZE * batch_records)                      #Made once, the samples are packed into it
+        self.capacity = batch_records
+        self.count    = 0                                                           #Records in the buffer that are not written yet
+        self.lock     = allocate_lock()                                             #The white and black scanner threads both record
+        self.timer    = StopWatch()
+        self.started  = False
+        self.file     = open(path, "wb")
+        self.file.write(struct.pack(HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, *[max(0, min(255, int(value))) for value in limits]))
+
+    def record(self, channel, value):
+        if self.started == False:                                                   #Time 0 is the first sample
+            self.timer.reset()
+            self.started = True
+        time = self.timer.time()                                                    #Read the time before taking the lock, no device is used while it is held
+        self.lock.acquire()
+        if self.count == self.capacity: self._write()
+        struct.pack_into(RECORD_FORMAT, self.buffer, self.count * RECORD_SIZE, time, channel, value)
+        self.count += 1
+        self.lock.release()
+
+    def _write(self):                                                               #Only call while holding the lock
+        if self.count == 0: return
+        self.file.write(memoryview(self.buffer)[:self.count * RECORD_SIZE])
+        self.file.flush()
+        self.count = 0
+
+    def flush(self):                                                                #Write all buffered samples to the file, call it every few seconds
+        self.lock.acquire()
+        self._write()
+        self.lock.release()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class RecordedColorSensor:
+    """
+    RecordedColorSensor
+    Color sensor that saves every rgb() sample in the trace.
+    """
+
+    def __init__(self, sensor, recorder, channel):
+        self.sensor   = sensor
+        self.recorder = recorder
+        self.channel  = channel
+
+    def rgb(self):
+        value = self.sensor.rgb()
+        self.recorder.record(self.channel, pack_rgb(value))
+        return value
+
+    def __getattr__(self, name):                                                    #Everything else goes to the real sensor
+        return getattr(self.sensor, name)
+
+
+class RecordedMotor:
+    """
+    RecordedMotor
+    Motor that saves every angle() sample in the trace.
+    """
+
+    def __init__(self, motor, recorder, channel):
+        self.motor    = motor
+        self.recorder = recorder
+        self.channel  = channel
+
+    def angle(self):
+        value = self.motor.angle()
+        self.recorder.record(self.channel, value)
+        return value
+
+    def __getattr__(self, name):                                                    #run(), brake(), run_target() etc go to the real motor
+        return getattr(self.motor, name)
+
+
+def read_trace(path):                                                               #Returns (limits, {channel: (times, values)}), the lists are in recording order
+    with open(path, "rb") as trace_file:
+        data = trace_file.read()
+    header = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if header[0] != TRACE_MAGIC: raise ValueError("{} is not a pin sorter trace".format(path))
+    if header[1] != TRACE_VERSION: raise ValueError("{} has trace version {}, expected {}".format(path, header[1], TRACE_VERSION))
+    limits   = list(header[2:])
+    channels = {}
+    usable   = HEADER_SIZE + (len(data) - HEADER_SIZE) // RECORD_SIZE * RECORD_SIZE   #A trace cut off while writing ends with half a record
+    for offset in range(HEADER_SIZE, usable, RECORD_SIZE):
+        time, channel, value = struct.unpack_from(RECORD_FORMAT, data, offset)
+        if channel not in channels: channels[channel] = ([], [])
+        channels[channel][0].append(time)
+        channels[channel][1].append(value)
+    return limits, channels
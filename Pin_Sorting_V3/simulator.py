@@ -0,0 +1,810 @@
+# Simulated EV3 devices for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# hardware.py uses these devices when pybricks is not available, so a sorting program runs on a normal computer.
+# All devices share 1 virtual clock. Every thread started with the Thread class below takes turns: the thread that
+# is furthest behind in virtual time runs, and every device call moves its time forward by what that call costs on
+# the brick. A run with the same seed is repeatable, and runs much faster than real time.
+#
+# The machine is modelled in belt coordinates: a pin on the scanning belt is saved as the scanning motor angle at
+# which its front reaches the white sensor. The motors follow the speed and acceleration set with control.limits(),
+# the feeder drops pins drawn from the pins_scanned datasets, and the swingarm belt drops them in the bin the swingarm
+# points at. world.stats() tells how well the program sorted them, and how often and how late the color sensors saw them.
+#
+# By default every thread has its own processor, so threads only wait for each other in the program itself. With
+# single_core the threads share 1 processor like on the EV3: a device call has to wait until the calls of the other
+# threads are done, only wait() and waiting for a motor leave the processor to the other threads.
+#
+# Run a sorting program in the simulator with:      python3 simulator.py main_v5_esp.py --seconds 600
+# The same on 1 processor core, like the EV3:       python3 simulator.py main_v5_esp.py --seconds 600 --single-core
+# Replay a trace recorded on the machine with:      python3 simulator.py main_v5_esp.py --replay trace.bin
+# In a replay no pins are simulated, the color sensors and the scanning belt angle give the recorded samples instead.
+
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import traceback
+
+
+##########~~~~~~~~~~COST OF EVERY DEVICE CALL IN VIRTUAL MILLISECONDS~~~~~~~~~~##########
+COLOR_READ_MS    = 1.0                                                              #ColorSensor.rgb()
+ANGLE_READ_MS    = 0.2                                                              #Motor.angle() and Motor.speed()
+MOTOR_COMMAND_MS = 0.3                                                              #Motor.run(), stop(), run_target() etc
+TIMER_READ_MS    = 0.05                                                             #StopWatch.time()
+TOUCH_READ_MS    = 0.5                                                              #TouchSensor.pressed() and the brick buttons
+SCREEN_MS        = 2.0                                                              #Drawing text on the EV3 screen
+UART_MS          = 2.0                                                              #A call over the UART to the ESP
+PHYSICS_STEP_MS  = 2.0                                                              #Largest time step used to move the machine forward
+
+
+class SimulationFinished(Exception):
+    """Raised in every simulated thread when the virtual run time is over, or when the simulation stopped on an error."""
+
+
+##########~~~~~~~~~~VIRTUAL CLOCK~~~~~~~~~~##########
+class _Task:
+    def __init__(self, start_time, sequence):
+        self.time     = start_time                                                  #Virtual time this thread has reached
+        self.sequence = sequence                                                    #Start order, to choose between threads at the same time
+        self.event    = threading.Event()                                           #Set when it is this threads turn to run
+
+
+class VirtualClock:
+    """
+    VirtualClock
+    Lets the simulated threads run one by one in virtual time order, so a run does not depend on the real thread timing.
+    """
+
+    def __init__(self, stall_timeout=30, single_core=False):
+        self.now           = 0.0
+        self.single_core   = single_core                                            #All threads share 1 processor
+        self.busy_until    = 0.0                                                    #Virtual time the shared processor is done with the last device call
+        self.end_time      = None                                                   #Virtual ms at which every thread gets SimulationFinished, None runs forever
+        self.finished      = False
+        self.error         = None
+        self.stall_timeout = stall_timeout                                          #Real seconds a thread may run without a device call, before the run is stopped
+        self.tasks         = []
+        self.by_ident      = {}
+        self.sequence      = 0
+
+    def add_task(self):                                                             #A new thread starts at the current virtual time
+        task = _Task(self.now, self.sequence)
+        self.sequence += 1
+        self.tasks.append(task)
+        return task
+
+    def current_task(self):
+        ident = threading.get_ident()
+        task  = self.by_ident.get(ident)
+        if task is None:                                                            #The main thread is added the first time it uses a device
+            task = self.add_task()
+            self.by_ident[ident] = task
+        return task
+
+    def remove_task(self, task):
+        if task in self.tasks: self.tasks.remove(task)
+        for ident in list(self.by_ident):
+            if self.by_ident[ident] is task: del self.by_ident[ident]
+        if len(self.tasks) > 0 and self.finished == False: self._next_task().event.set()
+
+    def _next_task(self):
+        return min(self.tasks, key=lambda task: (task.time, task.sequence))
+
+    def advance(self, ms, busy=True):                                               #Spend ms of virtual time in the calling thread, and let other threads catch up
+        task = self.current_task()
+        if busy and self.single_core:                                               #The call starts when the processor is free, and keeps it busy
+            task.time = max(task.time, self.busy_until) + ms
+            self.busy_until = task.time
+        else:
+            task.time += ms
+        self.run_in_turn(task)
+
+    def run_in_turn(self, task):
+        while True:
+            if self.finished: raise SimulationFinished()
+            next_task = self._next_task()
+            if next_task is task: break
+            task.event.clear()
+            next_task.event.set()
+            if task.event.wait(self.stall_timeout) == False and self.finished == False:
+                self.finish("a thread kept running for {} seconds without using a device or wait()".format(self.stall_timeout))
+        self.now = task.time
+        if self.end_time is not None and self.now >= self.end_time:
+            self.finish()
+            raise SimulationFinished()
+
+    def finish(self, error=None):                                                   #Stop the simulation, every waiting thread wakes up and raises SimulationFinished
+        if error is not None and self.error is None: self.error = error
+        self.finished = True
+        for task in self.tasks: task.event.set()
+
+
+##########~~~~~~~~~~THE SIMULATED MACHINE~~~~~~~~~~##########
+class TraceReplay:
+    """
+    TraceReplay
+    Samples from a trace recorded with sensor_trace.py, given back in the order they were recorded.
+    """
+
+    resync_ms = 5                                                                   #A program that reads faster or slower than the recording is kept within this many ms of it
+
+    def __init__(self, limits, channels):
+        self.limits   = limits                                                      #limits_scanned used while recording
+        self.channels = channels                                                    #Channel: (times, values)
+        self.cursors  = {}
+        self.start    = None                                                        #Virtual time of the first replayed sample, the recording also starts at its first sample
+        self.end      = 0
+        for channel in channels:
+            self.cursors[channel] = 0
+            self.end = max(self.end, channels[channel][0][-1])
+
+    def has(self, channel):
+        return channel in self.channels
+
+    def value(self, channel):                                                       #The next recorded sample of this channel, as long as it fits the current replay time
+        _spend(TIMER_READ_MS)                                                       #The recorder read its timer after every sample, so the threads keep the same timing
+        if self.start is None: self.start = clock.now
+        elapsed = clock.now - self.start
+        if elapsed > self.end + self.resync_ms:                                     #The trace is over, so is the run
+            clock.finish()
+            raise SimulationFinished()
+        times, values = self.channels[channel]
+        cursor = self.cursors[channel]
+        while cursor + 1 < len(times) and times[cursor] < elapsed - self.resync_ms: cursor += 1     #Skip samples this program did not read in time
+        if times[cursor] > elapsed + self.resync_ms: return values[max(0, cursor - 1)]              #Read more often than recorded, give the last sample again
+        if cursor + 1 < len(times): self.cursors[channel] = cursor + 1
+        return values[cursor]
+
+
+class SimPin:
+    def __init__(self, name, angle, length_white, length_black, white, black):
+        self.name         = name
+        self.angle        = angle                                                   #Swingarm angle of the bin this pin belongs in
+        self.length_white = length_white                                            #° of scanning belt motion the pin covers the white sensor
+        self.length_black = length_black                                            #° of scanning belt motion the pin covers the black sensor
+        self.white        = white                                                   #RGB seen by the white background sensor
+        self.black        = black                                                   #RGB seen by the black background sensor
+        self.position     = 0                                                       #Scanning motor angle at which the pin front reaches the white sensor
+
+
+class SimWorld:
+    """
+    SimWorld
+    The conveyor belts, the pins on them and the bins, moved forward in virtual time by the simulated motors.
+    """
+
+    sensor_spacing   = 240                                                          #° of scanning belt between the white and the black sensor
+    feed_to_white    = 150                                                          #° of scanning belt between the spot pins drop on the belt and the white sensor
+    hopper_return    = 220                                                          #° before the white sensor where a reversed pin falls back in the hopper
+    drop_after_black = 15                                                           #° after the pin end passed the black sensor, where it falls on the swingarm belt
+    dropoff_distance = 2000                                                         #° of swingarm belt motion before a pin falls in its bin
+    bin_tolerance    = 40                                                           #° the swingarm may be off from the bin angle
+    edge_blur        = 6                                                            #° over which a pin edge fades into the background
+    latency_ms       = 3                                                            #Age of the belt position a color reading shows
+    feed_gap_min     = 60                                                           #Minimum ° of feeder motion between 2 pins
+    feed_gap_mean    = 250                                                          #Average ° of feeder motion between 2 pins
+    background_noise = 0.5                                                          #Standard deviation of a background color reading
+    pin_noise        = 0.3                                                          #Standard deviation of a pin color reading, plus pin_noise_scale * value
+    pin_noise_scale  = 0.04
+    white_background = (26.0, 34.5, 26.5)                                           #Empty belt colors the pins_scanned table of main_v5_esp.py was made with
+    black_background = ( 1.0,  2.5,  3.5)
+    motor_ports      = {"turning_arm": "A", "storage_belt": "B", "scanning_belt": "C", "feeder_belt": "D"}
+    sensor_ports     = {"color_black": "S3", "color_white": "S4"}
+
+    def __init__(self, seed=0):
+        self.random         = random.Random(seed)
+        self.pin_types      = None                                                  #List of (name, bin angle, dataset, weight)
+        self.mix            = None                                                  #Optional dictionary pin name: weight for the feeder
+        self.motors         = {}
+        self.updated        = 0.0
+        self.scanning_pins  = []
+        self.storage_pins   = []                                                    #(pin, swingarm belt angle when it landed)
+        self.next_feed      = None
+        self.button_presses = [["center"]]                                          #Buttons the simulated user presses in the menu, each held for button_hold_ms
+        self.button_hold_ms = 100
+        self.button_release = None                                                  #Virtual time the held buttons are released
+        self.start_hooks    = []                                                    #Called the first time the program polls the buttons, all globals exist by then
+        self.counters       = {"pins_fed": 0, "pins_dropped": 0, "pins_binned": 0, "pins_correct": 0, "pins_wrong": 0, "pins_returned": 0}
+        self.binned         = {}                                                    #Pin name: [correct, wrong]
+        self.replay         = None                                                  #TraceReplay that gives the sensor samples instead of the simulated pins
+        self.samples        = {}                                                    #Sensor port: [color readings, virtual time of the first, virtual time of the last]
+        self.in_view        = {}                                                    #Sensor port: the pin the last reading saw
+        self.detections     = {}                                                    #Sensor port: ° the pin front was past the sensor at the first reading that saw the pin
+
+    def load_pin_types(self, pins_scanned, mix=None):                               #Pins the feeder can supply, drawn from the pins_scanned datasets
+        self.pin_types = []
+        if mix is not None: self.mix = mix
+        for name in pins_scanned:
+            dataset = pins_scanned[name]["dataset"]
+            if dataset[0] >= dataset[1]: continue                                   #ReScan and Reject are no real pins
+            weight = 1 if self.mix is None else self.mix.get(name, 0)
+            if weight > 0: self.pin_types.append((name, pins_scanned[name]["angle"], list(dataset), weight))
+
+    def _pin_types(self):
+        if self.pin_types is None:                                                  #Started without the runner, the program itself is the main module
+            program = sys.modules.get("__main__")
+            self.load_pin_types(getattr(program, "pins_scanned", {}))
+        return self.pin_types
+
+    def new_pin(self):
+        types = self._pin_types()
+        if len(types) == 0: return None
+        total = 0
+        for pin_type in types: total += pin_type[3]
+        pick = self.random.uniform(0, total)
+        for name, angle, dataset, weight in types:
+            pick -= weight
+            if pick <= 0: break
+        def inside(low, high):                                                      #Stay in the middle 60% of the dataset limits, like a well tuned table
+            span = high - low
+            return self.random.uniform(low + 0.2 * span, high - 0.2 * span)
+        values = [inside(dataset[x], dataset[x + 1]) for x in range(0, 16, 2)]
+        return SimPin(name, angle, values[0], values[1], values[2:5], values[5:8])
+
+    def add_motor(self, motor):
+        self.motors[motor.port] = motor
+
+    def motor(self, role):
+        return self.motors.get(self.motor_ports[role])
+
+    def start_position(self, port):
+        if port == self.motor_ports["turning_arm"]: return 300                      #The swingarm starts a bit away from its touch sensor
+        return 0
+
+    def update(self, now):                                                          #Move every motor and pin forward to the virtual time now, in small steps
+        while self.updated < now:
+            step = min(PHYSICS_STEP_MS, now - self.updated)
+            self.updated += step
+            for motor in self.motors.values(): motor._update(self.updated)
+            self._move_pins()
+
+    def _move_pins(self):
+        scanning = self.motor("scanning_belt")
+        if scanning is None or self.replay is not None: return
+        belt = scanning.position
+        feeder = self.motor("feeder_belt")
+        if feeder is not None:                                                      #The feeder drops the next pin when it moved far enough
+            if self.next_feed is None: self.next_feed = feeder.position + self._feed_gap()
+            while feeder.position >= self.next_feed:
+                self.next_feed += self._feed_gap()
+                pin = self.new_pin()
+                if pin is None: continue
+                pin.position = belt + self.feed_to_white
+                if len(self.scanning_pins) > 0:                                     #A pin dropped on a standing belt lands against the previous pin
+                    last = self.scanning_pins[-1]
+                    pin.position = max(pin.position, last.position + last.length_white)
+                self.scanning_pins.append(pin)
+                self.counters["pins_fed"] += 1
+        storage = self.motor("storage_belt")
+        for pin in list(self.scanning_pins):
+            if belt > pin.position + self.sensor_spacing + max(pin.length_white, pin.length_black) + self.drop_after_black:
+                self.scanning_pins.remove(pin)                                      #Fell off the end of the scanning belt onto the swingarm belt
+                self.storage_pins.append((pin, storage.position if storage is not None else 0))
+                self.counters["pins_dropped"] += 1
+            elif belt < pin.position - self.feed_to_white - self.hopper_return:
+                self.scanning_pins.remove(pin)                                      #Reversed past the feeder, back in the hopper
+                self.counters["pins_returned"] += 1
+        if storage is None: return
+        arm = self.motor("turning_arm")
+        for item in list(self.storage_pins):
+            pin, landed = item
+            if storage.position >= landed + self.dropoff_distance:                  #Falls off the swingarm belt, in the bin the swingarm points at now
+                self.storage_pins.remove(item)
+                arm_angle = arm.position + arm.offset if arm is not None else 0
+                moving    = arm is not None and math.fabs(arm.velocity) > 100
+                correct   = moving == False and math.fabs(arm_angle - pin.angle) <= self.bin_tolerance
+                self.counters["pins_binned"] += 1
+                self.counters["pins_correct" if correct else "pins_wrong"] += 1
+                result = self.binned.setdefault(pin.name, [0, 0])
+                result[0 if correct else 1] += 1
+
+    def _feed_gap(self):
+        return self.feed_gap_min + self.random.expovariate(1 / max(1, self.feed_gap_mean - self.feed_gap_min))
+
+    def read_color(self, port):
+        samples = self.samples.setdefault(port, [0, clock.now, clock.now])
+        samples[0] += 1
+        samples[2]  = clock.now
+        if self.replay is not None:
+            from sensor_trace import CHANNEL_WHITE, CHANNEL_BLACK, unpack_rgb
+            channel = CHANNEL_WHITE if port == self.sensor_ports["color_white"] else CHANNEL_BLACK
+            if self.replay.has(channel): return unpack_rgb(self.replay.value(channel))
+        scanning = self.motor("scanning_belt")
+        belt = 0 if scanning is None else scanning.position - scanning.velocity * self.latency_ms / 1000
+        white = port == self.sensor_ports["color_white"]
+        background = self.white_background if white else self.black_background
+        value = background
+        noise = [self.background_noise] * 3
+        seen  = None
+        for pin in self.scanning_pins:
+            start  = pin.position + (0 if white else self.sensor_spacing)
+            length = pin.length_white if white else pin.length_black
+            inside = belt - start
+            if 0 <= inside <= length:
+                seen  = pin
+                if self.in_view.get(port) is not pin and scanning.velocity > 0:      #First reading of this pin while the belt runs forward
+                    self.detections.setdefault(port, []).append(inside)
+                fade  = min(1, inside / self.edge_blur, (length - inside) / self.edge_blur)
+                color = pin.white if white else pin.black
+                value = [background[x] + (color[x] - background[x]) * fade for x in range(3)]
+                noise = [self.pin_noise + self.pin_noise_scale * value[x] for x in range(3)]
+                break
+        self.in_view[port] = seen
+        return tuple(min(100, max(0, int(round(self.random.gauss(value[x], noise[x]))))) for x in range(3))
+
+    def calibration(self):                                                          #Background limits like calibration_sensors() would find them, in the calibrationdata.txt order
+        limits = []
+        for background in (self.white_background, self.black_background):
+            limits.extend([int(round(value - 1.5 * self.background_noise - 0.5)) for value in background])
+            limits.extend([int(round(value + 1.5 * self.background_noise + 0.5)) for value in background])
+        return limits
+
+    def touch_pressed(self):
+        arm = self.motor("turning_arm")
+        return arm is not None and arm.position <= 0                                #The touch sensor is at physical swingarm angle 0
+
+    def poll_buttons(self):
+        if len(self.start_hooks) > 0:
+            hooks = self.start_hooks
+            self.start_hooks = []
+            for hook in hooks: hook()
+        if len(self.button_presses) == 0: return []
+        if self.button_release is None: self.button_release = clock.now + self.button_hold_ms
+        if clock.now < self.button_release: return [getattr(Button, name.upper()) for name in self.button_presses[0]]
+        self.button_presses.pop(0)                                                  #Released, the next press starts at the next poll
+        self.button_release = None
+        return []
+
+    def stats(self):
+        result = dict(self.counters)
+        result["virtual_seconds"] = round(clock.now / 1000, 3)
+        result["pins_on_belts"]   = len(self.scanning_pins) + len(self.storage_pins)
+        scanning = self.motor("scanning_belt")
+        feeder   = self.motor("feeder_belt")
+        result["scanning_brakes"]     = 0 if scanning is None else scanning.brakes
+        result["scanning_reversals"]  = 0 if scanning is None else scanning.reversals
+        result["scanning_stopped_ms"] = 0 if scanning is None else round(scanning.stopped_ms)
+        result["feeder_stops"]        = 0 if feeder is None else feeder.stops
+        for role in self.sensor_ports:                                              #"white" and "black": readings per second, and how far and how evenly the pin was past the sensor when first seen
+            port    = self.sensor_ports[role]
+            name    = role.replace("color_", "")
+            samples = self.samples.get(port, [0, 0, 0])
+            seen    = self.detections.get(port, [])
+            mean    = sum(seen) / len(seen) if len(seen) > 0 else 0
+            result[name + "_samples_per_second"] = round(samples[0] / (samples[2] - samples[1]) * 1000, 1) if samples[2] > samples[1] else 0
+            result[name + "_detection_delay"]    = round(mean, 2)
+            result[name + "_detection_jitter"]   = round(math.sqrt(sum([(value - mean) ** 2 for value in seen]) / len(seen)), 2) if len(seen) > 0 else 0
+        result["binned"] = dict(self.binned)
+        return result
+
+
+clock = VirtualClock()
+world = SimWorld()
+
+
+def reset(seed=0, single_core=False):                                               #Start a new simulation, devices made before this keep using the old one
+    global clock
+    global world
+    clock = VirtualClock(single_core=single_core)
+    world = SimWorld(seed)
+    return world
+
+
+def _spend(ms, busy=True):                                                          #busy is False for waiting, the processor is free for the other threads then
+    clock.advance(ms, busy)
+    world.update(clock.now)
+
+
+##########~~~~~~~~~~PYBRICKS PARAMETERS~~~~~~~~~~##########
+class Port:
+    A  = "A"
+    B  = "B"
+    C  = "C"
+    D  = "D"
+    S1 = "S1"
+    S2 = "S2"
+    S3 = "S3"
+    S4 = "S4"
+
+
+class Stop:
+    COAST = "coast"
+    BRAKE = "brake"
+    HOLD  = "hold"
+
+
+class Direction:
+    CLOCKWISE        = "clockwise"
+    COUNTERCLOCKWISE = "counterclockwise"
+
+
+class Button:
+    UP     = "up"
+    DOWN   = "down"
+    LEFT   = "left"
+    RIGHT  = "right"
+    CENTER = "center"
+
+
+class Color:
+    BLACK  = "black"
+    WHITE  = "white"
+    RED    = "red"
+    GREEN  = "green"
+    BLUE   = "blue"
+    YELLOW = "yellow"
+    ORANGE = "orange"
+
+
+##########~~~~~~~~~~PYBRICKS TOOLS~~~~~~~~~~##########
+def wait(time):
+    _spend(max(time, 0.01), False)
+
+
+class StopWatch:
+    def __init__(self):
+        self._start  = clock.now
+        self._paused = None
+
+    def time(self):
+        _spend(TIMER_READ_MS)
+        end = clock.now if self._paused is None else self._paused
+        return int(end - self._start)
+
+    def reset(self):
+        self._start = clock.now
+        if self._paused is not None: self._paused = clock.now
+
+    def pause(self):
+        if self._paused is None: self._paused = clock.now
+
+    def resume(self):
+        if self._paused is not None:
+            self._start += clock.now - self._paused
+            self._paused = None
+
+
+class Thread:
+    """
+    Thread
+    Same use as threading.Thread, but the thread runs in turn with the other simulated threads on the virtual clock.
+    """
+
+    def __init__(self, target=None, args=(), kwargs=None):
+        self.target = target
+        self.args   = args
+        self.kwargs = kwargs or {}
+
+    def start(self):
+        own_clock = clock
+        task = own_clock.add_task()
+        thread = threading.Thread(target=self._run, args=(own_clock, task))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, own_clock, task):
+        task.event.wait()
+        own_clock.by_ident[threading.get_ident()] = task
+        try:
+            if own_clock.finished == False: self.target(*self.args, **self.kwargs)
+        except SimulationFinished:
+            pass
+        except Exception:
+            traceback.print_exc()
+            own_clock.finish("thread {} stopped with an error".format(getattr(self.target, "__name__", self.target)))
+        finally:
+            own_clock.remove_task(task)
+
+
+##########~~~~~~~~~~EV3 DEVICES~~~~~~~~~~##########
+class _Control:
+    def __init__(self, motor):
+        self._motor = motor
+
+    def limits(self, speed=None, acceleration=None, actuation=None):
+        motor = self._motor
+        if speed is None and acceleration is None and actuation is None: return (motor.max_speed, motor.acceleration, motor.actuation)
+        if speed        is not None: motor.max_speed    = speed
+        if acceleration is not None: motor.acceleration = acceleration
+        if actuation    is not None: motor.actuation    = actuation
+
+    def target_tolerances(self, speed=None, position=None):
+        motor = self._motor
+        if speed is None and position is None: return (motor.speed_tolerance, motor.position_tolerance)
+        if speed    is not None: motor.speed_tolerance    = speed
+        if position is not None: motor.position_tolerance = position
+
+    def done(self):                                                                 #True when the last run_target() or run_angle() reached its target
+        _spend(ANGLE_READ_MS)
+        return self._motor.done
+
+
+class Motor:
+    """
+    Motor
+    EV3 motor that accelerates and decelerates with the acceleration from control.limits().
+    """
+
+    coast_deceleration = 1500                                                       #deg/s² when stopped without braking
+    brake_deceleration = 20000                                                      #deg/s² when braked or holding
+
+    def __init__(self, port, positive_direction=Direction.CLOCKWISE, gears=None):
+        self.port               = port
+        self.position           = world.start_position(port)                        #Physical angle, never reset
+        self.offset             = 0                                                 #angle() = position + offset
+        self.velocity           = 0.0
+        self.mode               = "stop"                                            #"run", "target", "stop", "brake" or "hold"
+        self.run_speed          = 0
+        self.target             = 0
+        self.done               = True
+        self.max_speed          = 1000
+        self.acceleration       = 2000
+        self.actuation          = 100
+        self.speed_tolerance    = 50
+        self.position_tolerance = 10
+        self.updated            = clock.now
+        self.brakes             = 0
+        self.stops              = 0
+        self.reversals          = 0
+        self.stopped_ms         = 0.0                                               #Virtual ms spent stopped or braked, before the next run command
+        self.stopped_since      = None
+        self.control            = _Control(self)
+        world.add_motor(self)
+
+    def _update(self, now):
+        elapsed = (now - self.updated) / 1000
+        self.updated = now
+        if elapsed <= 0: return
+        if self.mode == "target":
+            self._move_to_target(elapsed)
+            return
+        if   self.mode == "run":   goal, rate = self.run_speed, self.acceleration
+        elif self.mode == "stop":  goal, rate = 0, self.coast_deceleration
+        else:                      goal, rate = 0, self.brake_deceleration
+        change = goal - self.velocity
+        ramp   = math.fabs(change) / rate                                           #Seconds needed to reach the goal speed
+        if ramp >= elapsed:
+            new_velocity = self.velocity + math.copysign(rate * elapsed, change)
+            self.position += (self.velocity + new_velocity) / 2 * elapsed
+            self.velocity = new_velocity
+        else:
+            self.position += (self.velocity + goal) / 2 * ramp + goal * (elapsed - ramp)
+            self.velocity = goal
+
+    def _move_to_target(self, elapsed):
+        rate = self.acceleration
+        while elapsed > 0 and self.mode == "target":
+            step = min(elapsed, 0.001)
+            elapsed -= step
+            remaining = self.target - self.position
+            direction = 1 if remaining >= 0 else -1
+            if math.fabs(remaining) <= self.position_tolerance and math.fabs(self.velocity) <= self.speed_tolerance: self.done = True
+            if math.fabs(remaining) < 0.5 and math.fabs(self.velocity) <= rate * step * 2:
+                self._arrive()
+                break
+            if self.velocity * direction > 0 and self.velocity * self.velocity / (2 * rate) >= math.fabs(remaining):
+                self.velocity -= direction * rate * step                            #Braking towards the target
+            else:
+                self.velocity += direction * rate * step
+                if math.fabs(self.velocity) > self.run_speed: self.velocity = math.copysign(self.run_speed, self.velocity)
+            new_position = self.position + self.velocity * step
+            if (self.target - new_position) * direction < 0:
+                self._arrive()
+                break
+            self.position = new_position
+
+    def _arrive(self):
+        self.position = self.target
+        self.velocity = 0.0
+        self.mode     = "hold"
+        self.done     = True
+
+    def angle(self):
+        _spend(ANGLE_READ_MS)
+        if world.replay is not None and self.port == world.motor_ports["scanning_belt"]:
+            from sensor_trace import CHANNEL_ANGLE
+            if world.replay.has(CHANNEL_ANGLE): return world.replay.value(CHANNEL_ANGLE)
+        return int(round(self.position + self.offset))
+
+    def speed(self):
+        _spend(ANGLE_READ_MS)
+        return int(round(self.velocity))
+
+    def reset_angle(self, angle=0):
+        _spend(MOTOR_COMMAND_MS)
+        self.offset = angle - self.position
+
+    def _start_moving(self):                                                        #Add the time since the last stop or brake to stopped_ms
+        if self.stopped_since is not None: self.stopped_ms += clock.now - self.stopped_since
+        self.stopped_since = None
+
+    def run(self, speed):
+        _spend(MOTOR_COMMAND_MS)
+        self._start_moving()
+        self.mode      = "run"
+        self.run_speed = max(-self.max_speed, min(self.max_speed, speed))
+        self.done      = True
+
+    def stop(self):
+        _spend(MOTOR_COMMAND_MS)
+        self.mode = "stop"
+        self.stops += 1
+        if self.stopped_since is None: self.stopped_since = clock.now
+
+    def brake(self):
+        _spend(MOTOR_COMMAND_MS)
+        self.mode = "brake"
+        self.brakes += 1
+        if self.stopped_since is None: self.stopped_since = clock.now
+
+    def hold(self):
+        _spend(MOTOR_COMMAND_MS)
+        self.mode = "hold"
+
+    def run_target(self, speed, target_angle, then=Stop.HOLD, wait=True):
+        _spend(MOTOR_COMMAND_MS)
+        self._start_moving()
+        self.target    = target_angle - self.offset
+        self.run_speed = min(math.fabs(speed), self.max_speed)
+        self.mode      = "target"
+        self.done      = False
+        if self.target < self.position: self.reversals += 1
+        if wait:
+            while self.done == False: _spend(PHYSICS_STEP_MS, False)
+
+    def run_angle(self, speed, rotation_angle, then=Stop.HOLD, wait=True):
+        direction = -1 if speed < 0 else 1
+        self.run_target(speed, self.position + self.offset + direction * rotation_angle, then, wait)
+
+
+class ColorSensor:
+    def __init__(self, port):
+        self.port = port
+
+    def rgb(self):
+        _spend(COLOR_READ_MS)
+        return world.read_color(self.port)
+
+
+class TouchSensor:
+    def __init__(self, port):
+        self.port = port
+
+    def pressed(self):
+        _spend(TOUCH_READ_MS)
+        return world.touch_pressed()
+
+
+class _Screen:
+    def clear(self):                   _spend(SCREEN_MS)
+    def set_font(self, font):          pass
+    def draw_text(self, x, y, text, text_color=Color.BLACK, background_color=None): _spend(SCREEN_MS)
+    def print(self, *args, **kwargs):  _spend(SCREEN_MS)
+
+
+class _Speaker:
+    def set_volume(self, volume, which="_all_"):                                    pass
+    def set_speech_options(self, language=None, voice=None, speed=None, pitch=None): pass
+    def beep(self, frequency=500, duration=100):                                    wait(duration)
+    def say(self, text):                                                            wait(500)
+
+
+class _Light:
+    def on(self, color): pass
+    def off(self):       pass
+
+
+class _Buttons:
+    def pressed(self):
+        _spend(TOUCH_READ_MS)
+        return world.poll_buttons()
+
+
+class EV3Brick:
+    def __init__(self):
+        self.screen  = _Screen()
+        self.speaker = _Speaker()
+        self.light   = _Light()
+        self.buttons = _Buttons()
+
+
+class Font:
+    def __init__(self, family=None, size=12, bold=False, monospace=False, lang=None, script=None):
+        self.size = size
+
+
+class UARTDevice:
+    def __init__(self, port, baudrate=115200, timeout=None):
+        self.port = port
+
+    def read(self, length=1): return b""
+    def write(self, data):    return len(data)
+    def waiting(self):        return 0
+    def clear(self):          pass
+
+
+class UartRemote:
+    """
+    UartRemote
+    Stands in for the ESP connection, every call is answered and the screen data is kept in sent.
+    """
+
+    def __init__(self, port=0, baudrate=115200, timeout=1500, debug=False):
+        self.port     = port
+        self.commands = {}
+        self.sent     = []
+
+    def add_command(self, command_function, format="", name=None):
+        self.commands[name or command_function.__name__] = command_function
+
+    def call(self, cmd, *argv):
+        _spend(UART_MS)
+        self.sent.append((cmd, argv[1:] if len(argv) > 1 else argv))
+        return ("ack", None)
+
+    def process_uart(self):
+        _spend(UART_MS / 4)
+
+
+##########~~~~~~~~~~RUNNING A SORTING PROGRAM~~~~~~~~~~##########
+def run_program(path, seconds=600, seed=0, overrides=None, mix=None, setup=None, replay=None, single_core=False):
+    """
+    Run a sorting program (like main_v5_esp.py) for a number of virtual seconds.
+    overrides is a dictionary of global variables that is set right after the program started, mix sets how often every pin
+    is fed. replay is the path of a recorded trace, the run then stops at the end of the trace. single_core lets all
+    threads share 1 processor, like on the EV3.
+    Returns (program globals, world.stats()).
+    """
+    sim_world = reset(seed, single_core)
+    clock.end_time = seconds * 1000
+    path = os.path.abspath(path)
+    if replay is not None:                                                          #The program has to use the background limits the trace was recorded with
+        from sensor_trace import read_trace
+        limits, channels = read_trace(replay)
+        sim_world.replay = TraceReplay(limits, channels)
+        with open("calibrationdata.txt", "w") as calibration:
+            for value in limits: calibration.write(str(value) + "\n")
+    elif os.path.exists("calibrationdata.txt") == False:                              #Like a machine that was calibrated before, with the simulated empty belt
+        with open("calibrationdata.txt", "w") as calibration:
+            for value in sim_world.calibration(): calibration.write(str(value) + "\n")
+    if os.path.dirname(path) not in sys.path: sys.path.insert(0, os.path.dirname(path))
+    program = {"__name__": "__simulated__", "__file__": path}
+
+    def start():                                                                    #All settings exist now, the program is waiting in its menu
+        if overrides: program.update(overrides)
+        if "pins_scanned" in program: sim_world.load_pin_types(program["pins_scanned"], mix)
+        if setup is not None: setup(program, sim_world)
+    sim_world.start_hooks.append(start)
+
+    with open(path) as source:
+        code = compile(source.read(), path, "exec")
+    try:
+        exec(code, program)
+    except SimulationFinished:
+        pass
+    if clock.error is not None: raise RuntimeError("Simulation stopped: " + clock.error)
+    return program, sim_world.stats()
+
+
+if __name__ == "__main__":
+    import argparse
+    import simulator                                                                #hardware.py imports this file as simulator, the program has to use that same copy
+    parser = argparse.ArgumentParser(description="Run a pin sorter program on simulated EV3 devices")
+    parser.add_argument("program", help="sorting program, for example main_v5_esp.py")
+    parser.add_argument("--seconds", type=float, default=600, help="virtual seconds to run (default 600)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the pins and sensor noise")
+    parser.add_argument("--workdir", default=None, help="folder for calibrationdata.txt, a new temporary folder if not given")
+    parser.add_argument("--replay", default=None, help="trace recorded with record_trace = True, replayed instead of simulated pins")
+    parser.add_argument("--single-core", action="store_true", help="let all threads share 1 processor, like on the EV3")
+    arguments = parser.parse_args()
+    program_path = os.path.abspath(arguments.program)
+    replay_path  = os.path.abspath(arguments.replay) if arguments.replay else None
+    os.chdir(arguments.workdir or tempfile.mkdtemp(prefix="pinsorter_"))
+    program_globals, result = simulator.run_program(program_path, arguments.seconds, arguments.seed, replay=replay_path, single_core=arguments.single_core)
+    if "pins_scanned" in program_globals:                                           #How many of every pin the program counted, to compare runs on the same trace
+        result["counters"] = dict([(name, program_globals["pins_scanned"][name]["counter"]) for name in program_globals["pins_scanned"]])
+    print(json.dumps(result, indent=2, sort_keys=True))
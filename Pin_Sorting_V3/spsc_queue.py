@@ -0,0 +1,57 @@
+# Hand-over queues between the threads of the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# Every queue has exactly 1 thread that puts pin numbers in, and 1 thread that takes them out. The putting thread is the
+# only one that changes tail, the taking thread is the only one that changes head, so no lock is needed and no thread
+# ever changes something the other thread is busy with. The taking thread checks for new pins every ms, so it starts
+# working on a pin right after it was put in, instead of finding it at its next 100ms check.
+# A queue made with overwrite=True never makes the putting thread wait: when it is full the new item goes in anyway, and
+# the taking thread skips the oldest items that were written over. The taking thread only keeps an item if the ring did
+# not come round to it while it was reading it.
+# The taking thread can also look at the items that are waiting with peek(), without taking them out.
+
+from array import array
+from hardware import wait
+
+
+class SpscQueue:
+    """
+    SpscQueue
+    Fixed size ring of pin numbers, for 1 producer thread and 1 consumer thread.
+    """
+
+    def __init__(self, capacity=32, overwrite=False):
+        self.items     = array('i', [0] * capacity)
+        self.capacity  = capacity
+        self.overwrite = overwrite                                                  #True if put() writes over the oldest item of a full queue
+        self.head      = 0                                                          #Only changed by the consumer, items taken out
+        self.tail      = 0                                                          #Only changed by the producer, items put in
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def put(self, item):                                                            #Producer only, returns False if the queue is full and the item is not added
+        if self.overwrite == False and self.tail - self.head >= self.capacity: return False
+        self.items[self.tail % self.capacity] = item
+        self.tail += 1                                                              #Only now the consumer can see the item, it is completely written
+        return True
+
+    def peek(self, index=0):                                                        #Consumer only, the item index places after the oldest without taking it out, None if less are waiting
+        if index >= self.tail - self.head: return None
+        return self.items[(self.head + index) % self.capacity]
+
+    def get(self, timeout=0):                                                       #Consumer only, returns the oldest item, or None if nothing arrived within timeout ms
+        while True:
+            while self.tail == self.head:
+                if timeout <= 0: return None
+                wait(1)
+                timeout -= 1
+            if self.overwrite == False:
+                item = self.items[self.head % self.capacity]
+                self.head += 1
+                return item
+            if self.tail - self.head >= self.capacity: self.head = self.tail - self.capacity + 1     #Written over, skip to the oldest item that is still there
+            item = self.items[self.head % self.capacity]
+            if self.tail - self.head < self.capacity:                               #The producer did not start writing over this item while it was read
+                self.head += 1
+                return item
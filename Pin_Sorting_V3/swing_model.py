@@ -0,0 +1,45 @@
+# Swingarm motion time model for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# The swingarm does not move at its full speed right away: run_target() speeds it up and slows it down again with the
+# acceleration from turning_arm.control.limits(), so a move takes longer then the angle divided by the speed. A short
+# move does not even reach the full speed. After the profile, the motor still needs some time to settle within its
+# target_tolerances and to tell the move is done, and that time depends on the motor, its load and the battery.
+# A SwingModel gives the time of the speed profile, plus a settle time learned from the measured swingarm moves. The
+# largest difference of the last moves is used, so a slow move now and then still gets the time it needs, and the
+# time is never shorter then the profile itself.
+
+from array import array
+
+
+class SwingModel:
+    """
+    SwingModel
+    Time a swingarm move takes, from its trapezoidal speed profile and the settle time of the last measured moves.
+    """
+
+    def __init__(self, speed, acceleration, settle=100, size=10, minimum=3):
+        self.speed        = speed                                                   #deg/s the swingarm moves at, after speeding up
+        self.acceleration = acceleration                                            #deg/s² used to speed up and slow down
+        self.settle       = settle                                                  #ms after the profile before the move is done, learned from the measured moves
+        self.residuals    = array('f', [0] * size)                                  #Last measured move times minus their profile time, used as a ring
+        self.size         = size
+        self.minimum      = minimum                                                 #Measured moves needed before the first settle time is replaced
+        self.count        = 0
+
+    def profile(self, angle):                                                       #ms of the speed profile only, for a move of angle °
+        if angle <= 0: return 0
+        if angle >= self.speed * self.speed / self.acceleration:                    #Long enough to reach the full speed, speeding up and slowing down take speed / acceleration together
+            return (angle / self.speed + self.speed / self.acceleration) * 1000
+        return 2 * (angle / self.acceleration) ** 0.5 * 1000                        #Short move, it starts slowing down before the full speed is reached
+
+    def time(self, angle):                                                          #ms a move of angle ° takes until the swingarm stands still at the target
+        if angle <= 0: return 0
+        return self.profile(angle) + self.settle
+
+    def add(self, angle, measured):                                                 #Add 1 measured move of angle ° that took measured ms, only called by the swingarm stage
+        if angle <= 0: return
+        self.residuals[self.count % self.size] = measured - self.profile(angle)
+        self.count += 1
+        if self.count < self.minimum: return
+        self.settle = max(0, max(self.residuals[:min(self.count, self.size)]))
@@ -0,0 +1,205 @@
+# Parameter tuner for the Technic pin sorter
+# MIT License: Copyright (c) 2022 Mr Jos
+#
+# Finds the scanning settings and the pins_scanned datasets from traces recorded on the machine (record_trace = True, see
+# sensor_trace.py), instead of tuning them by hand. Every combination of settings is replayed through the sorting program
+# in the simulator, on all processor cores at the same time. The scan of every pin is collected, and for every
+# combination new dataset limits are made from the scans of traces with a known pin type.
+# The combination with the lowest rescan and misclassification rate wins. Its settings and the new pins_scanned table are
+# printed, in the same layout as in the program so they can be pasted over the old ones.
+#
+# A trace gets a known pin type by recording only 1 type of pin, and giving the name after the file:
+#   python3 tuner.py main_v5_esp.py --trace red3.bin="Red 3L" --trace tan2.bin="Tan 2L" --trace mixed.bin
+# Traces without a name only count for the rescan rate.
+#
+# To judge the new limits fairly, the scans of every pin type are split in 2 halves: limits made from 1 half are tested on
+# the other half, and the other way around. The printed table is made from all scans.
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+
+import simulator
+from benchmark import parse_settings
+from pin_classifier import PinTable
+
+
+DEFAULT_GRID = ["white_samples=3,5,7", "white_measuring_distance_start=20,30,40", "max_length_allowed=140,160,180", "black_measuring_distance_start=250,270,290"]
+LENGTH_PADDING = 3                                                                  #° always added around the measured lengths
+COLOR_PADDING  = 0.5                                                                #Always added around the measured color values
+SPREAD_PADDING = 0.1                                                                #Part of the measured spread added on both sides
+TRIM           = 0.02                                                               #Part of the scans left out on both ends as outliers (at least 1), if there are 20 or more
+MINIMUM_SCANS  = 3                                                                  #Scans needed of a pin type to make new limits for it
+
+
+def start_worker():                                                                 #Every worker process replays in its own folder, for its own calibrationdata.txt
+    os.chdir(tempfile.mkdtemp(prefix="pinsorter_tuner_"))
+
+
+def replay_scans(job):                                                              #Replay 1 trace with 1 combination of settings, returns (job, scans, pins_scanned of the program)
+    program_path, trace_path, settings = job
+    scans = []
+
+    def setup(program, sim_world):                                                  #Save every scan the program classifies
+        check_result_scans = program["check_result_scans"]
+        def saving_check(length_white, length_black, pin_clr):
+            scans.append([length_white, length_black] + list(pin_clr))
+            return check_result_scans(length_white, length_black, pin_clr)
+        program["check_result_scans"] = saving_check
+
+    overrides = dict(settings)
+    overrides["fuse_rescans"] = False                                               #The limits have to fit single scans, a pin is first classified on 1 scan
+    with contextlib.redirect_stdout(io.StringIO()):
+        program, stats = simulator.run_program(program_path, 24 * 3600, overrides=overrides, setup=setup, replay=trace_path)
+    return job, scans, program["pins_scanned"]
+
+
+def fit_datasets(scans_by_pin):                                                     #Make dataset limits that hold the scans of every pin type, returns {name: dataset}
+    datasets = {}
+    for name in scans_by_pin:
+        scans = scans_by_pin[name]
+        if len(scans) < MINIMUM_SCANS: continue
+        dataset = []
+        for feature in range(8):                                                    #2 lengths, then 6 colors, the same order as the dataset limits
+            values = sorted([scan[feature] for scan in scans])
+            if len(values) >= 20:
+                cut = max(1, int(len(values) * TRIM))
+                values = values[cut:len(values) - cut]
+            low     = values[0]
+            high    = values[-1]
+            padding = SPREAD_PADDING * (high - low)
+            if feature < 2: padding = max(padding, LENGTH_PADDING)
+            else:           padding = max(padding, COLOR_PADDING)
+            dataset.extend([int(max(0, math.floor(low - padding))), int(math.ceil(high + padding))])   #Rounded outwards to whole numbers, like the hand made tables
+        datasets[name] = dataset
+    return datasets
+
+
+def build_table(pins_scanned, datasets):                                            #Copy of pins_scanned with the new datasets, the counters set back to 0
+    table = {}
+    for name in pins_scanned:
+        dataset = datasets[name] if name in datasets else list(pins_scanned[name]["dataset"])
+        table[name] = {"counter": 0, "angle": pins_scanned[name]["angle"], "dataset": dataset}
+    return table
+
+
+def count_results(table, scans_by_pin):                                             #Returns (scans, rescans, wrong), a scan of an unknown pin type (None) can only be a rescan
+    pin_table = PinTable(table)
+    scans   = 0
+    rescans = 0
+    wrong   = 0
+    for name in scans_by_pin:
+        for scan in scans_by_pin[name]:
+            result = pin_table.classify(scan[0], scan[1], scan[2:])
+            scans += 1
+            if result == "ReScan": rescans += 1
+            elif name is not None and result != name: wrong += 1
+    return scans, rescans, wrong
+
+
+def evaluate(pins_scanned, scans_by_pin, wrong_weight):                             #Judge 1 combination of settings, returns the result and the table made from all its scans
+    labelled = {}
+    for name in scans_by_pin:
+        if name is not None: labelled[name] = scans_by_pin[name]
+    halves = [{}, {}]
+    for name in labelled:                                                           #Every other scan in the same half, so both halves cover the whole recording
+        halves[0][name] = labelled[name][0::2]
+        halves[1][name] = labelled[name][1::2]
+    scans   = 0
+    rescans = 0
+    wrong   = 0
+    for fit, test in ((0, 1), (1, 0)):
+        result = count_results(build_table(pins_scanned, fit_datasets(halves[fit])), halves[test])
+        scans   += result[0]
+        rescans += result[1]
+        wrong   += result[2]
+    table = build_table(pins_scanned, fit_datasets(labelled))
+    if None in scans_by_pin:
+        result = count_results(table, {None: scans_by_pin[None]})
+        scans   += result[0]
+        rescans += result[1]
+    rescan_rate = rescans / scans if scans > 0 else 1
+    wrong_rate  = wrong / scans if scans > 0 else 1
+    return {"scans": scans, "rescan_rate": round(rescan_rate, 4), "wrong_rate": round(wrong_rate, 4), "objective": round(rescan_rate + wrong_weight * wrong_rate, 4)}, table
+
+
+def format_value(value):                                                            #8.0 is written as 8, like in the program
+    if value == int(value): return str(int(value))
+    return str(value)
+
+
+def format_table(table):                                                            #The pins_scanned dictionary in the layout of the program
+    lines = []
+    names = list(table)
+    for number in range(len(names)):
+        name    = names[number]
+        dataset = [format_value(value) for value in table[name]["dataset"]]
+        text    = "{}: {{\"counter\" : 0 , \"angle\" : {:>4} , \"dataset\" : [{},     {},     {}]}}".format(
+                  ('"' + name + '"').ljust(13), table[name]["angle"],
+                  ",".join(["{:>4}".format(value) for value in dataset[:4]]),
+                  ",".join(["{:>3}".format(value) for value in dataset[4:10]]),
+                  ",".join(["{:>3}".format(value) for value in dataset[10:]]))
+        start = "pins_scanned = {" if number == 0 else "                "
+        end   = " , \\" if number < len(names) - 1 else " }"
+        lines.append(start + text + end)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the pin sorter settings and pins_scanned table on recorded traces")
+    parser.add_argument("program", help="sorting program, for example main_v5_esp.py")
+    parser.add_argument("--trace", action="append", required=True, metavar='FILE[="Pin name"]', help="recorded trace, with the pin type if it holds only 1 type")
+    parser.add_argument("--set", action="append", default=None, metavar="NAME=V1,V2", help="setting to search, all combinations are tried (default: " + " ".join(DEFAULT_GRID) + ")")
+    parser.add_argument("--wrong-weight", type=float, default=5, help="how much worse a pin in the wrong bin is than a rescan (default 5)")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(), help="processes to use (default: all cores)")
+    parser.add_argument("--output", default=None, help="JSON file to write the result of every combination to")
+    arguments = parser.parse_args()
+
+    program_path = os.path.abspath(arguments.program)
+    traces = []
+    for argument in arguments.trace:
+        path, _, name = argument.partition("=")
+        traces.append((os.path.abspath(path), name.strip() if name.strip() != "" else None))
+    labels = dict(traces)
+    combinations = parse_settings(arguments.set or DEFAULT_GRID)
+    jobs = []
+    for settings in combinations:
+        for path, name in traces: jobs.append((program_path, path, settings))
+
+    scans_by_combination = [{} for settings in combinations]
+    pins_scanned = None
+    pool = multiprocessing.Pool(arguments.jobs, initializer=start_worker)
+    done = 0
+    for job, scans, program_pins in pool.imap_unordered(replay_scans, jobs):
+        done += 1
+        pins_scanned = program_pins
+        scans_by_pin = scans_by_combination[combinations.index(job[2])]
+        maximum = job[2].get("max_length_allowed", 160)
+        scans_by_pin.setdefault(labels[job[1]], []).extend([scan for scan in scans if scan[0] < maximum and scan[1] < maximum])    #Too long (2 pins touching) is no scan of 1 pin
+        print("Replayed {}/{}: {} {} scans".format(done, len(jobs), os.path.basename(job[1]), len(scans)))
+    pool.close()
+    pool.join()
+
+    results = []
+    best    = None
+    for number in range(len(combinations)):
+        result, table = evaluate(pins_scanned, scans_by_combination[number], arguments.wrong_weight)
+        result["settings"] = combinations[number]
+        results.append(result)
+        if best is None or result["objective"] < best[0]["objective"]: best = (result, table)
+    results.sort(key=lambda result: result["objective"])
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output: json.dump(results, output, indent=2, sort_keys=True)
+
+    print("")
+    for result in results[:5]:
+        print("{:.4f}  rescans {:.1%}  wrong {:.1%}  {}".format(result["objective"], result["rescan_rate"], result["wrong_rate"], json.dumps(result["settings"], sort_keys=True)))
+    print("")
+    for name in sorted(best[0]["settings"]): print("{} = {:>5}".format(name.ljust(30), best[0]["settings"][name]))
+    print("")
+    print(format_table(best[1]))